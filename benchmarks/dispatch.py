@@ -0,0 +1,40 @@
+"""
+dispatch.py
+Micro-benchmark of the interpreter's per-token and per-expression paths.
+
+Times how long lolcode.py takes to type a literal (as the parser and GIMMEH
+do), to parse a single expression and to evaluate one, in nanoseconds per
+operation.
+
+Usage: python3 benchmarks/dispatch.py [NUMBER]
+"""
+
+import sys, os, timeit
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import lolcode
+
+def perOp(statement, number, setup='pass'):
+    "The best time of one run of statement, in nanoseconds."
+    timer = timeit.Timer(statement, setup, globals=globals())
+    return min(timer.repeat(5, number)) / number * 1e9
+
+if __name__ == "__main__":
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    # A frame where x and y are declared
+    env = lolcode.Env({'IT':0, 'x':1, 'y':2}, [None, 6, 7])
+    source = 'SUM OF x AN PRODUKT OF 3.5 AN DIFF OF y AN 1'
+    tree = lolcode.parseExpression(deque([deque(source.split())]))
+
+    print('%-32s %10s' % ('operation', 'ns/op'))
+    for text in ('42', '-7', '3.14', 'WIN', 'x', '"YARN"', 'inf'):
+        print('%-32s %10.1f' % ('type literal %s' % text,
+                                perOp('lolcode.literalValue(%r)' % text,
+                                      number)))
+    print('%-32s %10.1f' % ('parse expression',
+                            perOp('lolcode.parseExpression(deque([deque('
+                                  'source.split())]))', number // 4)))
+    print('%-32s %10.1f' % ('evaluate expression',
+                            perOp('lolcode.expression(tree, env)', number)))
@@ -0,0 +1,143 @@
+"""
+run.py
+Benchmark runner for the LOLCODE interpreter.
+
+Runs each benchmark in this directory with lolcode.py and reports its best
+wall time, peak memory (RSS) and operations per second. A benchmark gives
+the number of operations it performs on a line of its own:
+
+    BTW OPS 1000000
+
+Its output is checked against the matching .out file, if there is one.
+Results can be saved as JSON and compared against a saved baseline, in
+which case slowdowns beyond the threshold (or changed output) make the
+runner exit with status 1.
+
+Usage: python3 benchmarks/run.py [-n REPEAT] [-k NAME] [--json FILE]
+                                 [--baseline FILE] [--threshold PERCENT]
+                                 [-- lolcode.py options]
+"""
+
+import sys, os, getopt, glob, hashlib, json, re, subprocess, tempfile, time
+
+here = os.path.dirname(os.path.abspath(__file__))
+interpreter = os.path.join(os.path.dirname(here), 'lolcode.py')
+
+def countOps(path):
+    "The number of operations a benchmark says it performs, or None."
+    with open(path, 'r') as file:
+        for line in file:
+            match = re.match(r'\s*BTW OPS (\d+)', line)
+            if match:
+                return int(match.group(1))
+    return None
+
+def runOnce(path, options):
+    "Run a benchmark once, returning (wall, peak RSS in KB, status, output)."
+    with tempfile.TemporaryFile() as out:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, interpreter] + options +
+                                   ['-f', path], stdin=subprocess.DEVNULL,
+                                   stdout=out, stderr=subprocess.STDOUT)
+        # wait4 gives the resources used by this run alone
+        pid, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        out.seek(0)
+        return wall, usage.ru_maxrss, process.returncode, out.read()
+
+def runBenchmark(path, options, repeat):
+    "Run a benchmark repeat times and summarise the best run."
+    best = None
+    for i in range(repeat):
+        run = runOnce(path, options)
+        if best is None or run[0] < best[0]:
+            best = run
+    wall, rss, status, output = best
+
+    expected = os.path.splitext(path)[0] + '.out'
+    ok = status == 0
+    if os.path.exists(expected):
+        with open(expected, 'rb') as file:
+            ok = ok and file.read() == output
+
+    ops = countOps(path)
+    return { 'wall':wall, 'rss_kb':rss, 'status':status, 'ok':ok,
+             'ops':ops, 'ops_per_sec':ops / wall if ops else None,
+             'output_sha1':hashlib.sha1(output).hexdigest() }
+
+def compare(results, baseline, threshold):
+    """
+    Compare results against a baseline, returning the change in wall time
+    of each benchmark in percent and the names of those which regressed.
+    """
+    changes, regressed = {}, []
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base is None:
+            continue
+        changes[name] = (result['wall'] - base['wall']) / base['wall'] * 100
+        if (changes[name] > threshold or
+            result['output_sha1'] != base['output_sha1']):
+            regressed.append(name)
+    return changes, regressed
+
+def report(results, changes, regressed):
+    print('%-12s %9s %10s %14s %9s' %
+          ('benchmark', 'wall (s)', 'RSS (MB)', 'ops/sec', 'change'))
+    for name, result in sorted(results.items()):
+        rate = result['ops_per_sec']
+        change = changes.get(name)
+        notes = []
+        if not result['ok']:
+            notes.append('WRONG OUTPUT' if result['status'] == 0 else
+                         'EXIT STATUS %d' % result['status'])
+        if name in regressed:
+            notes.append('REGRESSED')
+        print('%-12s %9.3f %10.1f %14s %9s  %s' %
+              (name, result['wall'], result['rss_kb'] / 1024,
+               '-' if rate is None else '%.0f' % rate,
+               '-' if change is None else '%+.1f%%' % change,
+               ', '.join(notes)))
+
+if __name__ == "__main__":
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], 'n:k:',
+                                      ['json=', 'baseline=', 'threshold='])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+
+    repeat, names, output, baseline, threshold = 3, [], None, None, 10.0
+    for option, value in optlist:
+        if option == '-n':
+            repeat = int(value)
+        elif option == '-k':
+            names.append(value)
+        elif option == '--json':
+            output = value
+        elif option == '--baseline':
+            with open(value, 'r') as file:
+                baseline = json.load(file)
+        elif option == '--threshold':
+            threshold = float(value)
+
+    results = {}
+    for path in sorted(glob.glob(os.path.join(here, '*.lol'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if not names or name in names:
+            results[name] = runBenchmark(path, args, repeat)
+
+    changes, regressed = {}, []
+    if baseline is not None:
+        changes, regressed = compare(results, baseline, threshold)
+    report(results, changes, regressed)
+
+    if output is not None:
+        with open(output, 'w') as file:
+            json.dump({ 'options':args, 'repeat':repeat,
+                        'python':sys.version, 'results':results },
+                      file, indent=2, sort_keys=True)
+
+    if regressed or not all(result['ok'] for result in results.values()):
+        sys.exit(1)
@@ -3,25 +3,79 @@ lolcode.py
 Author: Chirantan Ekbote
 
 Simple interpreter for the esoteric programming language LOLCODE.
-"""
 
-from collections import deque
-import sys, getopt, copy
+The source is parsed once into an immutable tree of nodes, which is then
+walked by the evaluation functions. The main program is streamed: each of
+its statements runs as soon as it has been parsed.
+"""
 
-class Env(dict):
-    "An environment: a dict of {'var':val} pairs, with an outer Env."
-    def __init__(self, parms=(), args=(), outer=None):
-        self.update(zip(parms,args))
-        self['IT'] = None
+from collections import deque, namedtuple
+import sys, os, io, re, getopt, operator, math, marshal, hashlib, time
+import threading, signal, difflib, concurrent.futures, socket, json, stat
+import resource
+
+class Env(object):
+    "An environment: variable slots laid out by name, with an outer Env."
+    __slots__ = ('layout', 'slots', 'outer')
+    def __init__(self, layout, slots, outer=None):
+        self.layout = layout    # {'var':index} into slots
+        self.slots = slots
         self.outer = outer
     def find(self, var):
-        "Find the innermost Env where var appears."
-        return self if var in self else self.outer.find(var)
+        "Find the innermost Env where var has been declared, or None."
+        env = self
+        while env is not None:
+            index = env.layout.get(var)
+            if index is not None and env.slots[index] is not unset:
+                return env
+            env = env.outer
+        return None
 
 class FoundException(Exception):
     "A custom exception to catch return statements"
-    def __init__(self):
+    def __init__(self, result=None):
         self.value = 'Found return statement outside function.'
+        self.result = result
+    def __str__(self):
+        return self.value
+
+class TokenLine(deque):
+    "The tokens of a line, and the number of the source line they are on."
+    __slots__ = ('line',)
+    def __init__(self, tokens, line):
+        deque.__init__(self, tokens)
+        self.line = line
+
+class TokenLines(object):
+    """
+    The lines of tokens making up a program, read from a source of lines
+    only as far as the parser has looked. Supports the deque operations the
+    parser uses: lines[0], lines.popleft() and testing for emptiness.
+    """
+    __slots__ = ('lines', 'source')
+    def __init__(self, source):
+        self.lines = deque([])   # Lines read but not yet parsed
+        self.source = source
+    def fill(self):
+        "Read another line if there are none left, returning whether any are."
+        if not self.lines:
+            for line in self.source:
+                self.lines.append(line)
+                break
+        return len(self.lines) > 0
+    def __getitem__(self, index):
+        self.fill()
+        return self.lines[index]
+    def __bool__(self):
+        return self.fill()
+    def popleft(self):
+        self.fill()
+        return self.lines.popleft()
+
+class ParseError(Exception):
+    "A custom exception carrying the error message of a malformed statement"
+    def __init__(self, value):
+        self.value = value
     def __str__(self):
         return self.value
 
@@ -30,649 +84,3815 @@ class FoundException(Exception):
 #--------------------------------------------------------------------------
 
 code = deque([])
-global_env = Env()
+unset = object()    # The value of a variable before it is declared
+globalLayout = {'IT':0}     # Variable slots of the main program
+global_env = Env(globalLayout, [None])
 statement, exp, func = {}, {}, {}
+funcNames = set()   # Functions declared so far during parsing
+varScopes = [set()] # Variables declared so far during parsing, in the main
+                    # program and then in each function being parsed
+lookedUp = set()    # Variables the functions declared look up at run time
 types = { 'TROOF':bool, 'NUMBR':int, 'NUMBAR':float, 'YARN':str }
 values = { 'WIN':True, 'FAIL':False, 'NOOB':None }
+notLiteral = object()   # What literalValue returns for anything else
+batchInput = None   # File GIMMEH reads from instead of prompting, if any
+programOutput = None    # File VISIBLE and error messages write to, if not
+                        # standard output
+profiler = None     # The Profiler timing statements and calls, if any
+optimizing = False  # Whether programs are optimized before they run
+memos = {}          # The Memo of each pure function declared, by name
+memoSize = 4096     # Results each pure function keeps, 0 to keep none
+memoStats = False   # Whether to report how well the memos did at the end
+limited = False     # Whether the steps, time or memory of programs is limited
+strict = False      # Whether BOTH OF, EITHER OF, ALL OF and ANY OF evaluate
+                    # every operand, even once the result is decided
+quickening = True   # Whether operations are specialized for the types of
+                    # operand they keep seeing
+siteStats = False   # Whether to report how the quickened operations did
 
 #--------------------------------------------------------------------------
-# Statement Evaluation Functions
+# Parse Tree Nodes
 #--------------------------------------------------------------------------
 
-def found(env=global_env):
-    raise FoundException
+# Statements
+# count: the (counter, step, bound) of a counted loop, made by countedLoop
+Loop = namedtuple('Loop', 'name cond body count', defaults=(None,))
+# arms: ((cond, body), ...), and table: a MEBBE table made by switchTable
+IfBlock = namedtuple('IfBlock', 'body arms table', defaults=(None,))
+FuncDecl = namedtuple('FuncDecl', 'name params body layout nlocals pure')
+Print = namedtuple('Print', 'args')
+Input = namedtuple('Input', 'var')
+Assign = namedtuple('Assign', 'var value')
+Declare = namedtuple('Declare', 'var value')
+Found = namedtuple('Found', 'value')
+ExpStatement = namedtuple('ExpStatement', 'value')
+Error = namedtuple('Error', 'message')
+Profile = namedtuple('Profile', 'where node')   # Only when profiling
+
+# Expressions
+Literal = namedtuple('Literal', 'value')
+Var = namedtuple('Var', 'name')        # Looked up through the call frames
+Local = namedtuple('Local', 'name index')     # Always in the current frame
+Global = namedtuple('Global', 'name index')   # Only the main program has it
+Call = namedtuple('Call', 'name args')
+# site: the Site quickening the operation, or None
+BinOp = namedtuple('BinOp', 'op left right site', defaults=(None,))
+Not = namedtuple('Not', 'value')
+AllOf = namedtuple('AllOf', 'args')
+AnyOf = namedtuple('AnyOf', 'args')
+Cast = namedtuple('Cast', 'value type')
+
+# Keywords ending the arms of an O RLY? block
+ifArmEnd = ('MEBBE', 'NO', 'OIC')
+
+# Binary operators and the names used in their error messages
+binopNames = { 'BOTH SAEM':'equals comparison',
+               'DIFFRINT':'not equals comparison',
+               'BOTH OF':'BOTH comparison', 'EITHER OF':'EITHER comparison',
+               'BIGGR OF':'greater than comparison',
+               'SMALLR OF':'less than comparison',
+               'SUM OF':'addition operation',
+               'DIFF OF':'subtraction operation',
+               'PRODUKT OF':'multiplication operation',
+               'QUOSHUNT OF':'division operation',
+               'MOD OF':'modulo operation' }
+
+#--------------------------------------------------------------------------
+# Lexing
+#--------------------------------------------------------------------------
+
+# A token runs up to whitespace or a comma, except inside a YARN, which
+# keeps its spaces and commas; a comma on its own ends a line of tokens
+tokenPattern = re.compile(r'(?:[^\s,"]+|"[^"]*"|"[^\s,"]*)+|,')
+
+def tokenize(file):
+    """
+    Yield the lines of tokens in a file, as they are read: each line is split
+    at commas, and then into tokens. A YARN is a single token holding its
+    text exactly as written. Files opened in text mode end every line with a
+    newline, whether it ended with CR, CRLF or LF.
+    """
+    for number, line in enumerate(file, 1):
+        if len(line) > 1: #There is more than just a newline character
+            if '"' in line:
+                tokens = []
+                for token in tokenPattern.findall(line):
+                    if token != ',':
+                        tokens.append(token)
+                    elif tokens:
+                        yield TokenLine(tokens, number)
+                        tokens = []
+                if tokens:
+                    yield TokenLine(tokens, number)
+                continue
+            softbreaks = line.split(',')
+            for token in softbreaks:
+                tokens = token.split()
+                if tokens:
+                    yield TokenLine(tokens, number)
+
+#--------------------------------------------------------------------------
+# Statement Parsing Functions
+#--------------------------------------------------------------------------
+
+def isLine(line, keywords):
+    "Check whether a line consists of exactly the given keywords."
+    return tuple(line) == keywords
+
+def parseFound(lines=code):
+    if len(varScopes) == 1:
+        # In the main program it is an error before anything is evaluated
+        lines.popleft()
+        return Found(Literal(None))
+    try:
+        if lines[0].popleft() != 'FOUND' or lines[0].popleft() != 'YR':
+            raise IndexError
+        return Found(parseExpression(lines))
+    except IndexError:
+        raise ParseError("Error: invalid FOUND statement.")
 
-def funcDecl(env=global_env):
-    #print("funcDecl")
+def parseFuncDecl(lines=code):
     try:
-        if (code[0].popleft() != 'HOW' or code[0].popleft() != 'DUZ' or
-            code[0].popleft() != 'I'):
+        if (lines[0].popleft() != 'HOW' or lines[0].popleft() != 'DUZ' or
+            lines[0].popleft() != 'I'):
             raise IndexError
 
-        name = code[0].popleft()    # Get the function name
+        name = lines[0].popleft()    # Get the function name
 
         # Get the params
         params = []
-        if len(code[0]) > 0:    # We have params
-            if code[0].popleft() != 'YR':
+        if len(lines[0]) > 0:    # We have params
+            if lines[0].popleft() != 'YR':
                 raise IndexError
-            
-            params.append(code[0].popleft())
-            while len(code[0]) > 0:
-                if code[0].popleft() != 'AN' or code[0].popleft() != 'YR':
+
+            params.append(lines[0].popleft())
+            while len(lines[0]) > 0:
+                if lines[0].popleft() != 'AN' or lines[0].popleft() != 'YR':
                     raise IndexError
-                params.append(code[0].popleft())
+                params.append(lines[0].popleft())
 
-        code.popleft()  # Pop off function declaration
+        lines.popleft()  # Pop off function declaration
 
-        # Get the body of the function and add the params to the front
+        # Get the lines making up the body of the function
         funcbody = deque([])
-        funcbody.append(params)
-        while not (len(code[0]) == 4 and code[0][0] == 'IF' and
-                   code[0][1] == 'U' and code[0][2] == 'SAY' and
-                   code[0][3] == 'SO'):
-            funcbody.append(code.popleft())
+        while not isLine(lines[0], ('IF', 'U', 'SAY', 'SO')):
+            funcbody.append(lines.popleft())
 
         # Pop off keywords IF U SAY SO
-        funcbody.append(code.popleft())
-
-        # Add to the function dict
-        func[name] = funcbody       
+        lines.popleft()
     except IndexError:
-        print("Error: invalid function declaration.")
-        sys.exit(1)
+        raise ParseError("Error: invalid function declaration.")
 
-def loop(env=global_env):
-    #print("loop")
+    funcNames.add(name)
+    varScopes.append(set(params))
     try:
-        if not (code[0].popleft() == 'IM' and code[0].popleft() == 'IN' and
-                code[0].popleft() == 'YR'):
+        body = parseBlock(funcbody)
+    finally:
+        varScopes.pop()
+    return FuncDecl(name, tuple(params), body, None, 0, False)
+
+def parseLoop(lines=code):
+    try:
+        if not (lines[0].popleft() == 'IM' and lines[0].popleft() == 'IN' and
+                lines[0].popleft() == 'YR'):
             raise IndexError
-        
+
         # Get the loop name
-        name = code[0].popleft()
+        name = lines[0].popleft()
 
         # Get the loop condition
-        if code[0].popleft() != 'WILE':
-            raise IndexError       
-        cond = code.popleft()
+        if lines[0].popleft() != 'WILE':
+            raise IndexError
+        cond = parseExpression(deque([lines.popleft()]))
 
-        # Get the body of the loop
+        # Get the lines making up the body of the loop
         codeloop = deque([])
-        while not (len(code[0]) == 4 and code[0][0] == 'IM' and
-                   code[0][1] == 'OUTTA' and code[0][2] == 'YR' and
-                   code[0][3] == name):
-            codeloop.append(code.popleft())
-
-        # Evaluate loop
-        code.appendleft(deque(cond))
-        while(expression(env)):
-            # Add the code for the body of the loop and run it
-            code.extendleft(reversed(copy.deepcopy(codeloop)))
-            while not (len(code[0]) == 4 and code[0][0] == 'IM' and
-                       code[0][1] == 'OUTTA' and code[0][2] == 'YR'
-                       and code[0][3] == name):
-                codeBlock(env)
-                        
-            # Put the loop condition expression back in
-            code.appendleft(deque(cond))
-            
+        while not isLine(lines[0], ('IM', 'OUTTA', 'YR', name)):
+            codeloop.append(lines.popleft())
+
         # Remove end of loop keywords
-        code.popleft()
+        lines.popleft()
     except IndexError:
-        print("Error: invalid loop.")
-        sys.exit(1)
+        raise ParseError("Error: invalid loop.")
+
+    return Loop(name, cond, parseBlock(codeloop))
 
-def inputBlock(env=global_env):
-    #print("inputBlock")
-    val = input('LOL>> ')
+def parseInput(lines=code):
     try:
-        scope = env.find(code[0][1])
-    except AttributeError:  # Variable is not defined
-        print("Error: invalid GIMMEH statement.")
-        sys.exit(1)
+        name = lines[0][1]
+    except IndexError:
+        raise ParseError("Error: invalid GIMMEH statement.")
+    lines.popleft()  # Pop off GIMMEH statement
+    return Input(Var(name))
+
+def parsePrint(lines=code):
     try:
-        scope[code[0][1]] = values[val]
-    except KeyError:    # Not WIN, FAIL, or NOOB
-        try:
-            scope[code[0][1]] = int(val)
-        except ValueError:  # Not an int
-            try:
-                scope[code[0][1]] = float(val)
-            except ValueError:
-                # We have a string
-                scope[code[0][1]] = val               
-    code.popleft()  # Pop off GIMMEH statement
-    
-def printBlock(env=global_env):
-    #print("printBlock")
-    try:
-        code[0].popleft()
-        out = ''
-        while code[0][0] != 'MKAY?':
-            out += str(expression(env)).strip('"') + ' '
-        print(out)
-        code.popleft()
+        lines[0].popleft()
+        args = []
+        while lines[0][0] != 'MKAY?':
+            args.append(parseExpression(lines))
+        lines.popleft()
+        return Print(tuple(args))
     except (KeyError, IndexError):
-        print("Error: invalid VISIBLE statement.")
-        sys.exit(1)
+        raise ParseError("Error: invalid VISIBLE statement.")
 
-def assignment(env=global_env):
-    #print("assignment")
+def parseAssignment(lines=code):
     try:
-        name = code[0].popleft()        # pop off variable name
-        
-        if code[0].popleft() != 'R':    # Pop off keyword R
+        name = lines[0].popleft()       # pop off variable name
+
+        if lines[0].popleft() != 'R':   # Pop off keyword R
             raise IndexError
-        
-        env.find(name)[name] = expression(env)
-    except AttributeError:  # The variable has not been previously defined
-        env[name] = expression(env)
+
+        value = parseExpression(lines)
+        varScopes[-1].add(name)
+        return Assign(Var(name), value)
     except IndexError:
-        print("Error: invalid assignment.")
-        sys.exit(1)
-    
-def declaration(env=global_env):
-    #print("declaration")
-    try:       
-        if (code[0].popleft() != 'I' or code[0].popleft() != 'HAS' or
-            code[0].popleft() != 'A'):
-            raise IndexError
-        
-        name = code[0].popleft()
-        if name in env: # Variable has been previously defined in this scope
+        raise ParseError("Error: invalid assignment.")
+
+def parseDeclaration(lines=code):
+    try:
+        if (lines[0].popleft() != 'I' or lines[0].popleft() != 'HAS' or
+            lines[0].popleft() != 'A'):
             raise IndexError
 
-        if len(code[0]) > 0 and code[0].popleft() == 'ITZ':
-            env[name] = expression(env)
+        name = lines[0].popleft()
+        value = None
+        if len(lines[0]) > 0 and lines[0].popleft() == 'ITZ':
+            value = parseExpression(lines)
         else:
-            env[name] = None
-            code.popleft()
+            lines.popleft()
+        varScopes[-1].add(name)
+        return Declare(Var(name), value)
     except IndexError:
-        print("Error: Invalid declaration.")
-        sys.exit(1)
-             
-def elseIfBlock(env=global_env, depth=0):
-    while code[0][0] != 'MEBBE' and code[0][0] != 'NO' and code[0][0] != 'OIC':
-        code.popleft()
-
-    if code[0][0] == 'MEBBE':
-        code[0].popleft()
-        # Check the MEBBE expression and evaluate if true
-        if expression(env) == True:
-            while (code[0][0] != 'MEBBE' and code[0][0] != 'NO' and
-                   code[0][0] != 'OIC'):
-                codeBlock(env)
-        else:
-            elseIfBlock(env, depth + 1)    # This MEBBE was not true
-    elif code[0][0] == 'NO' and code[0][1] == 'WAI':
-        code.popleft()
-        # Evaluate the NO WAI code block
-        while (code[0][0] != 'MEBBE' and code[0][0] != 'NO' and
-               code[0][0] != 'OIC'):
-            codeBlock(env)
-
-    # Make sure we've reached OIC, end of if block
-    while depth == 0 and code[0][0] != 'OIC':
-        code.popleft()
-    code.popleft()  # Pop off keyword OIC
-    
-def ifBlock(env=global_env):
-    #print("ifblock")
-    try:
-        if code[0][0] != 'O' or code[0][1] != 'RLY?':
+        raise ParseError("Error: Invalid declaration.")
+
+def parseIfBlock(lines=code):
+    try:
+        if lines[0][0] != 'O' or lines[0][1] != 'RLY?':
             raise IndexError
-        # Pop off keywords and evaluate if block
-        code.popleft()
-        if env['IT']:    
-            # Find the YA RLY keyword
-            while 'YA' not in code[0] and 'RLY' not in code[0]:
-                code.popleft()
-
-            # Pop off YA RLY
-            code.popleft()
-        
-            # Execute statements
-            while (code[0][0] != 'MEBBE' and code[0][0] != 'NO' and
-                   code[0][0] != 'OIC'):
-                codeBlock(env)
-
-            # Make sure we've reached keyword OIC
-            while code[0][0] != 'OIC':
-                code.popleft()
-                
-            # Now pop that off
-            code.popleft()
-        else:
-            elseIfBlock(env)
+        lines.popleft()
+
+        # Find the YA RLY keyword
+        while ('YA' not in lines[0] and 'RLY' not in lines[0] and
+               lines[0][0] not in ifArmEnd):
+            lines.popleft()
+
+        # Get the YA RLY code block. Without one, the block is only an
+        # error if IT is true, as the arms after it may still be taken.
+        body = (Error("Error: invalid O RLY? block."),)
+        if lines[0][0] not in ifArmEnd:
+            lines.popleft()
+            body = parseBlock(lines, ifArmEnd)
+
+        # Get each MEBBE expression and its code block
+        arms = []
+        while lines[0][0] == 'MEBBE':
+            lines[0].popleft()
+            cond = parseExpression(lines)
+            arms.append((cond, parseBlock(lines, ifArmEnd)))
+
+        # A NO WAI block is an arm which is always taken
+        if lines[0][0] == 'NO' and lines[0][1] == 'WAI':
+            lines.popleft()
+            arms.append((None, parseBlock(lines, ifArmEnd)))
+
+        # Make sure we've reached keyword OIC
+        while lines[0][0] != 'OIC':
+            lines.popleft()
+
+        # Now pop that off
+        lines.popleft()
+        return IfBlock(body, tuple(arms))
     except IndexError:
-        print("Error: invalid O RLY? block.")
-        sys.exit(1)
+        raise ParseError("Error: invalid O RLY? block.")
 
-def comment(env=global_env):
-    #print("comment")
-    if code[0][0] == 'BTW':
-        code.popleft()
-    elif code[0][0] == 'OBTW':
+def parseComment(lines=code):
+    if lines[0][0] == 'BTW':
+        lines.popleft()
+    elif lines[0][0] == 'OBTW':
         try:
-            while code[0][-1] != 'TLDR':    # Last token is not TLDR
-                code.popleft()
-            code.popleft()                  # Pop off line with TLDR
-        except IndexError as err:
-            print("Error: unexpected end of file. Expecting keyword TLDR")
-            sys.exit(1)
+            while lines[0][-1] != 'TLDR':   # Last token is not TLDR
+                lines.popleft()
+            lines.popleft()                 # Pop off line with TLDR
+        except IndexError:
+            raise ParseError("Error: unexpected end of file. "
+                             "Expecting keyword TLDR")
 
 #--------------------------------------------------------------------------
-# Binary Operators and Functions
+# Expression Parsing Functions
 #--------------------------------------------------------------------------
 
-def funcEval(env=global_env):
-    #print("functionEval")
-    # get the body of the function
-    funcbody = copy.deepcopy(func[code[0].popleft()])
+def parseCall(lines=code):
+    name = lines[0].popleft()
 
-    # Get the params and create the environment
-    params = funcbody.popleft()
+    # Get the arguments
     args = []
-    while code[0][0] != 'MKAY?':
-        args.append(expression(env))
+    while lines[0][0] != 'MKAY?':
+        args.append(parseExpression(lines))
+    lines[0].popleft()  # pop off MKAY?
 
-    # Make sure we have the coorect number of arguments
-    if len(args) != len(params):
-        print("Error: invalid number of arguments in function call.")
-        sys.exit(1)
+    return Call(name, tuple(args))
 
-    code[0].popleft()  # pop off MKAY?
-    funcEnv = Env(params, args, env)    # Create the function environment
+def parseBinOp(lines=code):
+    op = lines[0][0]
+    if op == 'BOTH':
+        try:
+            op = 'BOTH OF' if lines[0][1] == 'OF' else 'BOTH SAEM'
+        except IndexError:
+            raise ParseError("Error: invalid BOTH expression.")
+    elif op != 'DIFFRINT':
+        op += ' OF'
 
-    # Add the function code and evaluate
-    out = None
-    code.extendleft(reversed(funcbody))
     try:
-        while not (len(code[0]) == 4 and code[0][0] == 'IF' and
-                   code[0][1] == 'U' and code[0][2] == 'SAY' and
-                   code[0][3] == 'SO'):
-            codeBlock(funcEnv)
-
-        # We've reached the end so pop off the last keywords
-        code.popleft()    
-    except FoundException:
-        # We've reached a return statement
-        if code[0].popleft() != 'FOUND' or code[0].popleft() != 'YR':
-            print('Error: invalid FOUND statement.')
-            sys.exit(1)
-        out = expression(funcEnv)
-
-        # Now get rid of excess function code
-        while not (len(code[0]) == 4 and code[0][0] == 'IF' and
-                   code[0][1] == 'U' and code[0][2] == 'SAY' and
-                   code[0][3] == 'SO'):
-            code.popleft()
-
-        # pop off keywords
-        code.popleft()
-
-    # Delete function environment and return output
-    del funcEnv
-    return out
-
-def getBinArgs(env=global_env):
-    # Get first expession
-    x = expression(env)
+        for keyword in op.split():
+            if lines[0].popleft() != keyword:
+                raise IndexError
 
-    # Check for separator keyword AN
-    if (code[0].popleft() != 'AN'):
-        raise IndexError
+        # Get arguments, separated by keyword AN
+        x = parseExpression(lines)
+        if lines[0].popleft() != 'AN':
+            raise IndexError
+        y = parseExpression(lines)
+
+        # BOTH OF and EITHER OF are ALL OF and ANY OF with two operands
+        if op == 'BOTH OF':
+            return AllOf((x, y))
+        elif op == 'EITHER OF':
+            return AnyOf((x, y))
+        return BinOp(op, x, y)
+    except IndexError:
+        raise ParseError("Error: invalid %s." % binopNames[op])
 
-    # Get second expression
-    y = expression(env)
-    
-    return (x, y)
+def parseNot(lines=code):
+    try:
+        if lines[0].popleft() != 'NOT':
+            raise IndexError
+        return Not(parseExpression(lines))
+    except IndexError:
+        raise ParseError("Error: invalid NOT operation.")
 
-def both(env=global_env):
+def parseManyOf(lines=code):
+    keyword = lines[0][0]
     try:
-        if (code[0].popleft() != 'BOTH' or code[0].popleft() != 'OF'):
+        lines[0].popleft()
+        if lines[0].popleft() != 'OF':
             raise IndexError
 
         # Get arguments
-        x, y = getBinArgs(env)
-            
-        return bool(x and y)
-    except IndexError:
-        print("Error: invalid BOTH comparison.")
-        sys.exit(1)
+        args = []
+        while lines[0][0] != 'MKAY?':
+            args.append(parseExpression(lines))
+            # See if there are any more arguments
+            if lines[0][0] == 'AN':
+                lines[0].popleft()   # Pop it off
+        lines[0].popleft()   # Pop off MKAY?
 
+        return (AllOf if keyword == 'ALL' else AnyOf)(tuple(args))
+    except IndexError:
+        raise ParseError("Error: invalid %s operation." % keyword)
 
-def either(env=global_env):
+def parseCast(lines=code):
     try:
-        if (code[0].popleft() != 'EITHER' or code[0].popleft() != 'OF'):
+        lines[0].popleft()       # Pop off keyword MAEK
+        value = parseExpression(lines)
+
+        if lines[0].popleft() != 'A':
             raise IndexError
 
-        # Get arguments
-        x, y = getBinArgs(env)
-            
-        return bool(x or y)
+        return Cast(value, lines[0].popleft())
     except IndexError:
-        print("Error: invalid EITHER comparison.")
-        sys.exit(1)
-
+        raise ParseError("Error: invalid cast.")
 
-def neg(env=global_env):
+def parseString(lines=code):
     try:
-        if code[0].popleft() != 'NOT':
+        if '"' not in lines[0][0]:
+            raise IndexError
+
+        out = lines[0].popleft()
+        # The lexer keeps a whole YARN in one token, so one without its
+        # closing quote has none on the rest of the line either
+        if out.count('"') < 2:
             raise IndexError
 
-        # Get expression value
-        x = expression(env)
-            
-        return not x
+        return Literal(out.strip('"'))
     except IndexError:
-        print("Error: invalid NOT operation.")
-        sys.exit(1)
+        raise ParseError("Error: invalid YARN.")
+
+# The usual shape of NUMBAR literals, which are typed without trying to
+# convert them to a NUMBR first and failing
+numbarShape = re.compile(r'[-+]?(\d+\.\d*|\.\d+)([eE][-+]?\d+)?')
+
+def literalValue(text):
+    """
+    Type text as a TROOF, NOOB, NUMBR or NUMBAR literal, or return
+    notLiteral if it is none of those. Only text which looks like a number
+    but has an unusual shape goes through a conversion which fails.
+    """
+    if text in values:
+        return values[text]
+    elif text.isdecimal():
+        return int(text)
+
+    # Numbers start with a digit, a sign, a point or a space, unless they
+    # are inf or nan
+    first = text[:1]
+    if first == '"' or first.isalpha() and first not in 'iInN':
+        return notLiteral
+    elif '.' in text and numbarShape.fullmatch(text):
+        return float(text)
+    try:
+        return int(text)
+    except ValueError:  # Not an int
+        try:
+            return float(text)
+        except ValueError:
+            return notLiteral
+
+def parseAtom(lines=code):
+    token = lines[0][0]
+    value = literalValue(token)
+    if value is not notLiteral:
+        out = Literal(value)
+    elif '"' in token:
+        return parseString(lines)
+    else:               # Anything else names a variable
+        out = Var(token)
+    lines[0].popleft()
+    return out
 
+def isVariable(name):
+    "Whether a variable has been declared with the name, hiding a function."
+    for names in varScopes:
+        if name in names:
+            return True
+    return False
+
+# Create expression parser dispatch dictionary
+expParsers = { 'BOTH':parseBinOp, 'DIFFRINT':parseBinOp, 'BIGGR':parseBinOp,
+               'SMALLR':parseBinOp, 'SUM':parseBinOp, 'DIFF':parseBinOp,
+               'PRODUKT':parseBinOp, 'QUOSHUNT':parseBinOp, 'MOD':parseBinOp,
+               'MAEK':parseCast, 'EITHER':parseBinOp, 'ALL':parseManyOf,
+               'ANY':parseManyOf, 'NOT':parseNot }
+
+def parseExpression(lines=code):
+    token = lines[0][0]
+    if token in expParsers:
+        out = expParsers[token](lines)
+    elif token in funcNames and not isVariable(token):
+        out = parseCall(lines)
+    else:
+        out = parseAtom(lines)
 
-def allOf(env=global_env):
-    try:
-        if (code[0].popleft() != 'ALL' or code[0].popleft() != 'OF'):
-            raise IndexError
+    # If there's nothing left, pop off empty command list
+    if lines and len(lines[0]) == 0:
+        lines.popleft()
 
-        # Get arguments
-        args = []
-        while code[0][0] != 'MKAY?':
-            args.append(expression(env))
-            # See if there are any more arguments
-            if code[0][0] == 'AN':
-                code[0].popleft()   # Pop it off
-        code[0].popleft()   # Pop off MKAY?
-        
-        return all(args)
+    return out
+
+#--------------------------------------------------------------------------
+# Block and Program Parsing
+#--------------------------------------------------------------------------
+
+# Create statement parser dispatch dictionary
+stmtParsers = {'IM':parseLoop, 'I':parseDeclaration, 'BTW':parseComment,
+               'VISIBLE':parsePrint, 'O':parseIfBlock, 'OBTW':parseComment,
+               'FOUND':parseFound, 'GIMMEH':parseInput, 'HOW':parseFuncDecl}
+
+def parseStatement(lines=code):
+    if lines[0][0] in stmtParsers:
+        return stmtParsers[lines[0][0]](lines)
+    elif 'R' in lines[0]:   # Maybe it's an assignment
+        return parseAssignment(lines)
+    else:                   # Must be an expression
+        return ExpStatement(parseExpression(lines))
+
+def parseStatements(lines=code, end=()):
+    """
+    Parse statements until a line starting with one of the end keywords,
+    yielding each as soon as it has been parsed. A malformed statement is
+    replaced by an Error node, so the error is only reported if and when
+    execution reaches it.
+    """
+    while lines and lines[0][0] not in end:
+        if profiler is not None:
+            where = ('line', lines[0].line, ' '.join(lines[0]))
+        try:
+            node = parseStatement(lines)
+            if node is not None and profiler is not None:
+                node = Profile(where, node)
+            if node is not None:    # Comments produce no node
+                yield node
+        except ParseError as err:
+            yield Error(err.value)
+            if lines:
+                lines.popleft()     # Skip the rest of the offending line
+        except IndexError:
+            yield Error("Error: unexpected end of file. "
+                        "Expecting keyword KTHXBAI")
+
+def parseBlock(lines=code, end=()):
+    return tuple(parseStatements(lines, end))
+
+def scanFuncNames(lines=code):
+    # Functions may be called before they are declared, so find every
+    # function name up front to tell calls apart from variables
+    for line in lines:
+        if len(line) > 3 and line[0] == 'HOW' and line[1] == 'DUZ':
+            funcNames.add(line[3])
+
+def streamProgram(lines=code):
+    "Yield the statements of the main program as they are parsed."
+    eof = Error("Error: unexpected end of file. Expecting keyword KTHXBAI")
+    try:
+        while lines[0][0] != 'HAI':
+            lines.popleft()
     except IndexError:
-        print("Error: invalid ALL operation.")
+        yield eof
+        return
+
+    # Now the program starts
+    lines.popleft()
+    yield from parseStatements(lines, ('KTHXBAI',))
+    if not lines:
+        yield eof
+
+def parseProgram(lines=code):
+    scanFuncNames(lines)
+    return tuple(streamProgram(lines))
+
+#--------------------------------------------------------------------------
+# Scope Resolution
+#--------------------------------------------------------------------------
+
+# What is known about the variables of the function (or main program)
+# being resolved:
+#   layout - {'var':index} of the slots in its call frame
+#   safe   - variables which are always declared before they are used
+#   held   - variables which the call frame of any function may hold, or
+#            None if that is not known yet
+#   main   - the layout of the main program's frame
+#   pure   - the names of the functions found to be pure
+Scope = namedtuple('Scope', 'layout safe held inFunction main pure')
+
+def expVars(node):
+    "Yield every variable read by an expression."
+    kind = node.__class__
+    if kind is Var or kind is Local or kind is Global:
+        yield node
+    elif kind is BinOp:
+        yield from expVars(node.left)
+        yield from expVars(node.right)
+    elif kind is Not or kind is Cast:
+        yield from expVars(node.value)
+    elif kind is Call or kind is AllOf or kind is AnyOf:
+        for arg in node.args:
+            yield from expVars(arg)
+
+def expCalls(node):
+    "Yield the name of every function called by an expression."
+    kind = node.__class__
+    if kind is BinOp:
+        yield from expCalls(node.left)
+        yield from expCalls(node.right)
+    elif kind is Not or kind is Cast:
+        yield from expCalls(node.value)
+    elif kind is Call or kind is AllOf or kind is AnyOf:
+        if kind is Call:
+            yield node.name
+        for arg in node.args:
+            yield from expCalls(arg)
+
+def funcDecls(body):
+    "Yield every function declaration in a block, however deeply nested."
+    for node in body:
+        kind = node.__class__
+        if kind is Profile:     # Look through the profiling of statements
+            node = node.node
+            kind = node.__class__
+        if kind is FuncDecl:
+            yield node
+            yield from funcDecls(node.body)
+        elif kind is Loop:
+            yield from funcDecls(node.body)
+        elif kind is IfBlock:
+            yield from funcDecls(node.body)
+            for cond, body in node.arms:
+                yield from funcDecls(body)
+
+def frameNames(body):
+    "Yield every variable a block may declare or assign in its own frame."
+    for node in body:
+        kind = node.__class__
+        if kind is Profile:     # Look through the profiling of statements
+            node = node.node
+            kind = node.__class__
+        if kind is Declare or kind is Assign:
+            yield node.var.name
+        elif kind is Loop:
+            yield from frameNames(node.body)
+        elif kind is IfBlock:
+            yield from frameNames(node.body)
+            for cond, body in node.arms:
+                yield from frameNames(body)
+
+def writtenNames(body):
+    "Yield every variable a block may declare, assign or read input into."
+    for node in body:
+        kind = node.__class__
+        if kind is Profile:
+            node = node.node
+            kind = node.__class__
+        if kind is Declare or kind is Assign or kind is Input:
+            yield node.var.name
+        elif kind is Loop:
+            yield from writtenNames(node.body)
+        elif kind is IfBlock:
+            yield from writtenNames(node.body)
+            for cond, body in node.arms:
+                yield from writtenNames(body)
+
+def safeNames(params, body):
+    """
+    Find the variables of a function body which are always declared before
+    they are used: IT, the params, and variables with a single unconditional
+    declaration which comes before any other use.
+    """
+    defined = set(params) | {'IT'}
+    dynamic = set()
+
+    def use(vars):
+        for var in vars:
+            if var.name not in defined:
+                dynamic.add(var.name)
+
+    def visit(body, top):
+        for node in body:
+            kind = node.__class__
+            if kind is Profile:
+                node = node.node
+                kind = node.__class__
+            if kind is Declare:
+                if node.value is not None:
+                    use(expVars(node.value))
+                if top and node.var.name not in defined | dynamic:
+                    defined.add(node.var.name)
+                else:
+                    dynamic.add(node.var.name)
+            elif kind is Assign:
+                use(expVars(node.value))
+                use([node.var])
+            elif kind is Input:
+                use([node.var])
+            elif kind is Print:
+                for arg in node.args:
+                    use(expVars(arg))
+            elif kind is Found or kind is ExpStatement:
+                use(expVars(node.value))
+            elif kind is Loop:
+                use(expVars(node.cond))
+                visit(node.body, False)
+            elif kind is IfBlock:
+                visit(node.body, False)
+                for cond, body in node.arms:
+                    if cond is not None:
+                        use(expVars(cond))
+                    visit(body, False)
+
+    visit(body, True)
+    return defined - dynamic
+
+def pureCalls(params, body):
+    """
+    Find the functions called by a function body which only reads and
+    writes variables of its own frame and has no other side effects: no
+    VISIBLE, GIMMEH, function declarations or errors. Returns None if the
+    body does anything else.
+    """
+    safe = safeNames(params, body)
+    calls = set()
+
+    def pure(value):
+        if any(var.name not in safe for var in expVars(value)):
+            return False    # A variable of a caller or the main program
+        calls.update(expCalls(value))
+        return True
+
+    def visit(body):
+        for node in body:
+            kind = node.__class__
+            if kind is Profile:
+                node = node.node
+                kind = node.__class__
+            if kind is Declare or kind is Assign:
+                if node.var.name not in safe or (node.value is not None and
+                                                 not pure(node.value)):
+                    return False
+            elif kind is Found or kind is ExpStatement:
+                if not pure(node.value):
+                    return False
+            elif kind is Loop:
+                if not pure(node.cond) or not visit(node.body):
+                    return False
+            elif kind is IfBlock:
+                if not visit(node.body):
+                    return False
+                for cond, body in node.arms:
+                    if (cond is not None and not pure(cond) or
+                        not visit(body)):
+                        return False
+            else:
+                return False
+        return True
+
+    return calls if visit(body) else None
+
+def pureFunctions(body, complete=True):
+    """
+    Find the names of the functions whose result only depends on their
+    args: those declared once, with pure bodies, which only call other pure
+    functions. Unless body is the complete program, a function may only
+    call itself, as the others could still be declared again.
+    """
+    decls = list(funcDecls(body))
+    counts = {}
+    for node in decls:
+        counts[node.name] = counts.get(node.name, 0) + 1
+
+    calls = {}
+    for node in decls:
+        if counts[node.name] == 1:
+            called = pureCalls(node.params, node.body)
+            if called is not None:
+                calls[node.name] = called
+
+    # Drop functions calling impure ones until there are none left to drop
+    dropped = True
+    while dropped:
+        dropped = False
+        for name, called in list(calls.items()):
+            if any(callee not in calls or not complete and callee != name
+                   for callee in called):
+                del calls[name]
+                dropped = True
+    return set(calls)
+
+def resolveVar(name, scope):
+    "Resolve a variable which is read, or written by GIMMEH."
+    if name in scope.safe:
+        return Local(name, scope.layout[name])
+    elif scope.inFunction and (scope.held is None or name in scope.held):
+        return Var(name)
+
+    # No function can hold this variable, so only the main program can
+    return mainVar(name, scope.main)
+
+def resolveStore(name, scope):
+    "Resolve a variable which is declared or assigned."
+    if name in scope.safe:
+        return Local(name, scope.layout[name])
+    elif scope.inFunction:
+        return Var(name)
+    return mainVar(name, scope.main)
+
+def mainVar(name, main):
+    "Resolve a variable of the main program, giving it a slot if it has none."
+    if name not in main:
+        main[name] = len(main)
+    return Global(name, main[name])
+
+def resolveExp(node, scope):
+    kind = node.__class__
+    if kind is Var:
+        return resolveVar(node.name, scope)
+    elif kind is BinOp:
+        return BinOp(node.op, resolveExp(node.left, scope),
+                     resolveExp(node.right, scope), newSite(node.op))
+    elif kind is Not or kind is Cast:
+        return node._replace(value=resolveExp(node.value, scope))
+    elif kind is Call or kind is AllOf or kind is AnyOf:
+        return node._replace(args=tuple(resolveExp(arg, scope)
+                                        for arg in node.args))
+    return node
+
+def resolveFunction(node, scope):
+    # Lay out the frame: IT, then the params, then the other variables
+    layout = {'IT':0}
+    for index, param in enumerate(node.params, 1):
+        if param != 'IT':   # IT always starts out as NOOB
+            layout[param] = index
+    nslots = 1 + len(node.params)
+    for name in frameNames(node.body):
+        if name not in layout:
+            layout[name] = nslots
+            nslots += 1
+
+    pure = node.name in scope.pure
+    scope = Scope(layout, safeNames(node.params, node.body), scope.held, True,
+                  scope.main, scope.pure)
+    return node._replace(body=resolveBlock(node.body, scope), layout=layout,
+                         nlocals=nslots - 1 - len(node.params), pure=pure)
+
+# The fewest constants worth making a table of MEBBE arms for
+switchMin = 4
+
+def switchTable(arms):
+    """
+    Make a table of the arms of an O RLY? block if every MEBBE compares the
+    same variable with a constant using BOTH SAEM, so the arm taken can be
+    looked up rather than found by testing the arms in turn. It is a
+    (var, cases, default) tuple: cases maps each constant to the index of
+    the first arm comparing with it, and default is the index of the NO
+    WAI arm, or None. Returns None if the arms are not like that.
+    """
+    var, cases, default = None, {}, None
+    for index, (cond, body) in enumerate(arms):
+        if cond is None:    # NO WAI
+            default = index
+            break
+        if cond.__class__ is not BinOp or cond.op != 'BOTH SAEM':
+            return None
+        left, right = cond.left, cond.right
+        if left.__class__ is Literal:
+            left, right = right, left
+        if (right.__class__ is not Literal or
+            left.__class__ not in (Local, Global, Var) or
+            var is not None and (left.__class__ is not var.__class__ or
+                                 left != var)):
+            return None
+        if right.value != right.value:  # NaN, which equals nothing
+            return None
+        var = left
+        cases.setdefault(right.value, index)
+    if len(cases) < switchMin:
+        return None
+    return var, cases, default
+
+def countedLoop(cond, body):
+    """
+    Find the counter of a loop which runs WILE DIFFRINT a variable AN a
+    bound, and ends by adding a constant NUMBR to the variable (or taking
+    one from it), so it can be run on Python ints instead of testing the
+    condition each time. The bound is a NUMBR or another variable. Returns
+    (counter, step, bound), or None if the loop is not like that or the
+    rest of the body assigns the counter or the bound itself.
+    """
+    if cond.__class__ is not BinOp or cond.op != 'DIFFRINT' or not body:
+        return None
+    counter, bound = cond.left, cond.right
+    if counter.__class__ is Literal:
+        counter, bound = bound, counter
+    if (counter.__class__ not in (Local, Global) or counter.name == 'IT' or
+        bound.__class__ not in (Literal, Local, Global) or
+        bound.__class__ is Literal and bound.value.__class__ is not int or
+        bound.__class__ is not Literal and bound.name in ('IT',
+                                                          counter.name)):
+        return None
+
+    last = body[-1]
+    if last.__class__ is not Assign or last.var != counter:
+        return None
+    value = last.value
+    if value.__class__ is not BinOp or value.op not in ('SUM OF', 'DIFF OF'):
+        return None
+    step, other = value.right, value.left
+    if value.op == 'SUM OF' and step.__class__ is not Literal:
+        step, other = other, step
+    if (step.__class__ is not Literal or step.value.__class__ is not int or
+        other.__class__ is not counter.__class__ or other != counter):
+        return None
+
+    names = set(writtenNames(body[:-1]))
+    if (counter.name in names or
+        bound.__class__ is not Literal and bound.name in names):
+        return None
+    return (counter, step.value if value.op == 'SUM OF' else -step.value,
+            bound)
+
+def resolveStatement(node, scope):
+    kind = node.__class__
+    if kind is Profile:
+        return node._replace(node=resolveStatement(node.node, scope))
+    elif kind is Loop:
+        cond = resolveExp(node.cond, scope)
+        body = resolveBlock(node.body, scope)
+        return Loop(node.name, cond, body, countedLoop(cond, body))
+    elif kind is IfBlock:
+        arms = tuple((cond if cond is None else resolveExp(cond, scope),
+                      resolveBlock(body, scope)) for cond, body in node.arms)
+        return IfBlock(resolveBlock(node.body, scope), arms,
+                       switchTable(arms))
+    elif kind is FuncDecl:
+        return resolveFunction(node, scope)
+    elif kind is Print:
+        return Print(tuple(resolveExp(arg, scope) for arg in node.args))
+    elif kind is Input:
+        return Input(resolveVar(node.var.name, scope))
+    elif kind is Assign:
+        var = resolveStore(node.var.name, scope)
+        value = resolveExp(node.value, scope)
+        # Adding to a variable's own value can build up a YARN in place,
+        # unless what is added is a constant NUMBR or NUMBAR
+        if (value.__class__ is BinOp and value.op == 'SUM OF' and
+            value.left.__class__ is var.__class__ and value.left == var and
+            (value.right.__class__ is not Literal or
+             value.right.value.__class__ is str)):
+            value = BinOp('APPEND', value.left, value.right)
+        return Assign(var, value)
+    elif kind is Declare:
+        value = node.value
+        if value is not None:
+            value = resolveExp(value, scope)
+        return Declare(resolveStore(node.var.name, scope), value)
+    elif kind is Found or kind is ExpStatement:
+        return kind(resolveExp(node.value, scope))
+    return node
+
+def resolveBlock(body, scope):
+    return tuple(resolveStatement(node, scope) for node in body)
+
+def resolveProgram(body, layout=globalLayout):
+    """
+    Resolve every variable of a parsed program to a slot in a call frame
+    where that can be done statically. LOLCODE functions see the variables
+    of their callers, so other variables are still looked up at run time.
+    """
+    held = set()
+    for node in funcDecls(body):
+        held.update(node.params)
+        held.update(frameNames(node.body))
+    held.add('IT')
+
+    for name in frameNames(body):
+        if name not in layout:
+            layout[name] = len(layout)
+    return resolveBlock(body, Scope(layout, safeNames((), body), held, False,
+                                    layout, pureFunctions(body)))
+
+def resolveTopLevel(node, layout=globalLayout):
+    """
+    Resolve a single statement of the main program without knowing the rest
+    of it, as it is streamed: the main program's variables are all resolved
+    to slots checked when they are read, and other variables of functions
+    are looked up at run time.
+    """
+    return resolveStatement(node, Scope(layout, (), None, False, layout,
+                                        pureFunctions((node,), False)))
+
+#--------------------------------------------------------------------------
+# Optimization
+#--------------------------------------------------------------------------
+
+# The value of IT when it is not known before the program runs
+unknown = object()
+
+# Binary operators which never fail, whatever their operands
+safeBinops = ('BOTH SAEM', 'DIFFRINT')
+
+# The longest YARN a constant expression is folded into, and about the most
+# digits of a NUMBR, which are estimated before the value is worked out
+foldLimit = 4096
+
+def isPure(node):
+    "Check whether evaluating an expression can have no effect and not fail."
+    kind = node.__class__
+    if kind is Literal or kind is Local:
+        return True
+    elif kind is Not:
+        return isPure(node.value)
+    elif kind is BinOp:
+        return (node.op in safeBinops and isPure(node.left) and
+                isPure(node.right))
+    elif kind is AllOf or kind is AnyOf:
+        return all(isPure(arg) for arg in node.args)
+    return False
+
+def valueSize(value):
+    "About how many characters a constant takes, without writing it out."
+    if value.__class__ is str:
+        return len(value)
+    elif value.__class__ is int:
+        return value.bit_length() * 30103 // 100000 + 1   # Decimal digits
+    return 1
+
+def foldSize(op, x, y):
+    "About how many characters a binary operator on constants gives."
+    if op == 'PRODUKT OF' and (x.__class__ is str or y.__class__ is str):
+        text, count = (x, y) if x.__class__ is str else (y, x)
+        if isinstance(count, int):  # Repeats the YARN
+            return len(text) * max(count, 0)
+        return 0    # Fails, which is left to run time anyway
+    elif op == 'PRODUKT OF' or op == 'SUM OF' or op == 'APPEND':
+        return valueSize(x) + valueSize(y)
+    return max(valueSize(x), valueSize(y))
+
+def fold(value, default):
+    "A Literal of a folded value, or default if it should not be folded."
+    if value.__class__ is str and len(value) > foldLimit:
+        return default
+    return Literal(value)
+
+def optimizeExp(node):
+    """
+    Fold the constant parts of an expression, and the operators whose value
+    is decided by a constant operand when the others are pure.
+    """
+    kind = node.__class__
+    if kind is BinOp:
+        left, right = optimizeExp(node.left), optimizeExp(node.right)
+        node = BinOp(node.op, left, right, newSite(node.op))
+        if (left.__class__ is Literal and right.__class__ is Literal and
+            foldSize(node.op, left.value, right.value) <= foldLimit):
+            try:
+                return fold(binops[node.op](left.value, right.value), node)
+            except Exception:   # Left to fail when it runs
+                return node
+        return node
+    elif kind is Not:
+        value = optimizeExp(node.value)
+        if value.__class__ is Literal:
+            return Literal(not value.value)
+        return Not(value)
+    elif kind is AllOf or kind is AnyOf:
+        # Constants which cannot decide the result are dropped, and one
+        # which does decides it if the other arguments are pure. Unless
+        # every argument is evaluated, those after it never are.
+        decides = kind is AnyOf
+        args = tuple(optimizeExp(arg) for arg in node.args)
+        if not strict:
+            for index, arg in enumerate(args):
+                if arg.__class__ is Literal and bool(arg.value) is decides:
+                    args = args[:index + 1]
+                    break
+        if any(arg.__class__ is Literal and bool(arg.value) is decides
+               for arg in args) and all(isPure(arg) for arg in args):
+            return Literal(decides)
+        args = tuple(arg for arg in args if arg.__class__ is not Literal or
+                     bool(arg.value) is decides)
+        if not args:
+            return Literal(not decides)
+        return kind(args)
+    elif kind is Cast:
+        value = optimizeExp(node.value)
+        node = Cast(value, node.type)
+        if value.__class__ is Literal:
+            try:
+                return fold(types[node.type](value.value), node)
+            except (AttributeError, KeyError, IndexError, TypeError,
+                    ValueError):  # Left to fail when it runs
+                return node
+        return node
+    elif kind is Call:
+        return Call(node.name, tuple(optimizeExp(arg) for arg in node.args))
+    return node
+
+def writesIT(body):
+    "Check whether running a block may change the IT of its frame."
+    for node in body:
+        kind = node.__class__
+        if kind is Profile:
+            node = node.node
+            kind = node.__class__
+        if kind is ExpStatement:
+            return True
+        elif kind is Assign or kind is Input or kind is Declare:
+            if node.var.name == 'IT':
+                return True
+        elif kind is Loop and writesIT(node.body):
+            return True
+        elif kind is IfBlock:
+            if writesIT(node.body) or any(writesIT(arm)
+                                          for cond, arm in node.arms):
+                return True
+    return False
+
+def optimizeIfBlock(node, it):
+    """
+    Optimize an O RLY? block given the value of IT, leaving out the arms
+    which can never be taken. Returns the statements it can be replaced
+    with and the value of IT after them.
+    """
+    if it is not unknown and it:    # YA RLY is always taken
+        return optimizeBlock(node.body, it, True)
+
+    body = () if it is not unknown else optimizeBlock(node.body, unknown)
+    arms = []
+    for cond, arm in node.arms:
+        if cond is not None:
+            cond = optimizeExp(cond)
+            if cond.__class__ is Literal:
+                if cond.value != True:  # Never taken
+                    continue
+                cond = None             # Always taken once it is reached
+        if cond is None and it is not unknown and not arms:
+            return optimizeBlock(arm, it, True)
+        arms.append((cond, optimizeBlock(arm, it)))
+        if cond is None:    # The arms after it can never be reached
+            break
+
+    if not body and not arms:
+        return (), it
+    node = IfBlock(body, tuple(arms), switchTable(arms))
+    return (node,), unknown if writesIT((node,)) else it
+
+def optimizeStatement(node, it):
+    """
+    Optimize a statement, given the value of IT before it runs, returning the
+    statements it can be replaced with and the value of IT after them.
+    """
+    kind = node.__class__
+    if kind is Profile:
+        nodes, it = optimizeStatement(node.node, it)
+        if len(nodes) == 1 and nodes[0].__class__ is not Profile:
+            return (node._replace(node=nodes[0]),), it
+        return nodes, it    # Their statements are profiled already
+    elif kind is ExpStatement:
+        value = optimizeExp(node.value)
+        return (ExpStatement(value),), (value.value if value.__class__ is
+                                         Literal else unknown)
+    elif kind is IfBlock:
+        return optimizeIfBlock(node, it)
+    elif kind is Loop:
+        cond = optimizeExp(node.cond)
+        if cond.__class__ is Literal and not cond.value:
+            return (), it   # Never runs
+        body = optimizeBlock(node.body, unknown)
+        return ((Loop(node.name, cond, body, countedLoop(cond, body)),),
+                unknown if writesIT(body) else it)
+    elif kind is FuncDecl:
+        # A call starts with IT as NOOB
+        return (node._replace(body=optimizeBlock(node.body, None)),), it
+    elif kind is Print:
+        return (Print(tuple(optimizeExp(arg) for arg in node.args)),), it
+    elif kind is Assign:
+        node = Assign(node.var, optimizeExp(node.value))
+    elif kind is Declare and node.value is not None:
+        node = Declare(node.var, optimizeExp(node.value))
+    elif kind is Found:
+        node = Found(optimizeExp(node.value))
+    if kind is Assign or kind is Input or kind is Declare:
+        if node.var.name == 'IT':
+            it = unknown
+    return (node,), it
+
+def optimizeBlock(body, it, statements=False):
+    """
+    Optimize a block, given the value of IT as it starts. Statements after
+    one which always leaves the block are dropped. Returns the block, or
+    with statements set the statements and the value of IT after them.
+    """
+    out = []
+    for node in body:
+        nodes, it = optimizeStatement(node, it)
+        out.extend(nodes)
+        last = out[-1] if out else None
+        if last.__class__ is Profile:
+            last = last.node
+        if last.__class__ is Found or last.__class__ is Error:
+            break   # Nothing after it ever runs
+    if statements:
+        return tuple(out), it
+    return tuple(out)
+
+def optimizeProgram(body):
+    "Optimize a resolved program, which starts with IT as NOOB."
+    return optimizeBlock(body, None)
+
+#--------------------------------------------------------------------------
+# Statement Evaluation Functions
+#--------------------------------------------------------------------------
+
+# What a statement returns to leave the function running it, rather than
+# None: FOUND YR leaves the value found in IT, or the function and args of
+# a call to make in place of this one
+returned = object()
+tailCall = object()
+
+def found(node, env=global_env):
+    value = node.value
+    if env.outer is None:   # FOUND YR in the main program
+        raise FoundException(expression(value, env))
+    elif value.__class__ is Call and profiler is None:
+        env.slots[0] = callArgs(value, env)
+        return tailCall
+    env.slots[0] = exp[value.__class__](value, env)
+    return returned
+
+def funcDecl(node, env=global_env):
+    # Add to the function dict, with an empty memo if the function is pure.
+    # Running the same declaration again keeps the results already found.
+    if func.get(node.name) is not node:
+        func[node.name] = node
+        if node.pure and memoSize:
+            memos[node.name] = Memo(node.name, memoSize)
+        declareLookups(node)
+
+def declareLookups(node):
+    """
+    Note the variables a function being declared, and the functions declared
+    in it, look up through the call frames of their callers.
+    """
+    for decl in (node,) + tuple(funcDecls(node.body)):
+        lookedUp.update(var.name for var in blockVars(decl.body)
+                        if var.__class__ is Var)
+
+def unseen(env):
+    """
+    Whether no function can find a variable in a call frame, as none which
+    is declared in it is looked up at run time.
+    """
+    if lookedUp.isdisjoint(env.layout):
+        return True
+    slots = env.slots
+    for name, index in env.layout.items():
+        if name in lookedUp and slots[index] is not unset:
+            return False
+    return True
+
+# What countLoop returns when the rest of a loop has to be run as usual
+uncounted = object()
+
+def countLoop(node, env, counting=False):
+    """
+    Run a counted loop while its counter and bound are NUMBRs, adding the
+    step to the counter straight after the rest of the body instead of
+    evaluating the increment and the condition. Both are read from their
+    slots each time, so a function called by the body may still set them.
+    Counts each iteration as a step if counting. Returns uncounted, having
+    finished the iteration, once either is not a NUMBR.
+    """
+    counter, step, bound = node.count
+    slots = (global_env if counter.__class__ is Global else env).slots
+    index = counter.index
+    if bound.__class__ is Literal:
+        limit = bound.value
+        bounds = None
+    else:
+        bounds = (global_env if bound.__class__ is Global else env).slots
+        limit = bounds[bound.index]
+    count = slots[index]
+    if count.__class__ is not int or limit.__class__ is not int:
+        return uncounted
+    if count == limit:
+        return None
+
+    body = node.body[:-1]
+    while True:
+        if counting:
+            tick()
+        for stmt in body:
+            done = statement[stmt.__class__](stmt, env)
+            if done is not None:
+                return done
+        count = slots[index]
+        if bounds is not None:
+            limit = bounds[bound.index]
+        if count.__class__ is not int or limit.__class__ is not int:
+            last = node.body[-1]
+            statement[last.__class__](last, env)
+            return uncounted
+        count += step
+        slots[index] = count
+        if count == limit:
+            return None
+
+def loop(node, env=global_env):
+    # The body is run straight from the tree on every iteration, so nothing
+    # is copied or allocated per iteration by the loop itself
+    if node.count is not None:
+        done = countLoop(node, env)
+        if done is not uncounted:
+            return done
+    cond, body = node.cond, node.body
+    while exp[cond.__class__](cond, env):
+        for stmt in body:
+            done = statement[stmt.__class__](stmt, env)
+            if done is not None:    # Leaving the function
+                return done
+
+def setInput(file):
+    "Read GIMMEH input from a file, without prompting for it."
+    global batchInput
+    batchInput = file
+
+def readValue():
+    "Read a line of input and type it as a TROOF, NUMBR, NUMBAR or YARN."
+    if batchInput is None:
+        # Everything printed so far comes before the prompt
+        (programOutput or sys.stdout).flush()
+        val = input('LOL>> ')
+    else:
+        val = batchInput.readline()
+        if not val:
+            raise EOFError('EOF when reading a line')
+        if val[-1] == '\n':
+            val = val[:-1]
+
+    value = literalValue(val)
+    if value is notLiteral:   # We have a string
+        return val
+    return value
+
+def inputBlock(node, env=global_env):
+    val = readValue()
+    var = node.var
+    if var.__class__ is Local:
+        env.slots[var.index] = val
+        return
+
+    scope = env.find(var.name)
+    if scope is None:   # Variable is not defined
+        print("Error: invalid GIMMEH statement.", file=programOutput)
         sys.exit(1)
+    scope.slots[scope.layout[var.name]] = val
+
+def visible(args):
+    "Print the values of a VISIBLE statement."
+    (programOutput or sys.stdout).write(''.join([str(arg).strip('"') + ' '
+                                                 for arg in args]) + '\n')
+
+def printBlock(node, env=global_env):
+    visible([expression(arg, env) for arg in node.args])
+
+def assignment(node, env=global_env):
+    value = expression(node.value, env)
+    var = node.var
+    kind = var.__class__
+    if kind is Local:
+        env.slots[var.index] = value
+    elif kind is Global:
+        global_env.slots[var.index] = value
+    else:
+        # Not previously defined, so it is defined in the current frame
+        scope = env.find(var.name) or env
+        scope.slots[scope.layout[var.name]] = value
+
+def declaration(node, env=global_env):
+    var = node.var
+    kind = var.__class__
+    if kind is Local:   # The only declaration of the variable
+        slots, index = env.slots, var.index
+    else:
+        slots = global_env.slots if kind is Global else env.slots
+        index = var.index if kind is Global else env.layout[var.name]
+        if slots[index] is not unset: # Previously defined in this scope
+            print("Error: Invalid declaration.", file=programOutput)
+            sys.exit(1)
+
+    if node.value is None:
+        slots[index] = None
+    else:
+        slots[index] = expression(node.value, env)
+
+def ifBlock(node, env=global_env):
+    if env.slots[0]:    # IT
+        return codeBlock(node.body, env)
+    elif node.table is not None:
+        # Look up the MEBBE arm for the value of the variable compared
+        var, cases, default = node.table
+        index = cases.get(exp[var.__class__](var, env), default)
+        if index is not None:
+            return codeBlock(node.arms[index][1], env)
+    else:
+        # Take the first MEBBE arm that is true, or the NO WAI arm
+        for cond, body in node.arms:
+            if cond is None or expression(cond, env) == True:
+                return codeBlock(body, env)
+
+def expStatement(node, env=global_env):
+    env.slots[0] = expression(node.value, env)    # IT
+
+def error(node, env=global_env):
+    print(node.message, file=programOutput)
+    sys.exit(1)
 
-def anyOf(env=global_env):
+#--------------------------------------------------------------------------
+# Binary Operators and Functions
+#--------------------------------------------------------------------------
+
+def callArgs(node, env=global_env):
+    "The function a call calls and its args, once they are checked."
+    # get the function, registered once by funcDecl and never copied
     try:
-        if (code[0].popleft() != 'ANY' or code[0].popleft() != 'OF'):
-            raise IndexError
+        function = func[node.name]
+    except KeyError:    # Not declared yet, so it is not a valid value
+        print("Error: invalid YARN.", file=programOutput)
+        sys.exit(1)
 
-        # Get arguments
-        args = []
-        while code[0][0] != 'MKAY?':
-            args.append(expression(env))
-            # See if there are any more arguments
-            if code[0][0] == 'AN':
-                code[0].popleft()   # Pop it off
-        code[0].popleft()  # pop off MKAY?
-            
-        return any(args)
-    except IndexError:
-        print("Error: invalid ANY operation.")
+    # Get the args
+    args = [exp[arg.__class__](arg, env) for arg in node.args]
+
+    # Make sure we have the coorect number of arguments
+    if len(args) != len(function.params):
+        print("Error: invalid number of arguments in function call.",
+              file=programOutput)
         sys.exit(1)
-    
-def cast(env=global_env):
-    #print("cast")
-    try:
-        code[0].popleft()       # Pop off keyword MAEK 
-        exp = expression(env)
-        
-        if code[0].popleft() != 'A':
-            raise IndexError
-        
-        return types[code[0].popleft()](exp)       
+    return function, args
+
+def funcEval(node, env=global_env):
+    function, args = callArgs(node, env)
+
+    # A pure function gives the same result whenever it has the same args
+    memo = None
+    if function.pure and memoSize:
+        memo = memos[node.name]
+        key = memoKey(args)
+        result = memo.get(key)
+        if result is not missing:
+            return result
+
+    result = None
+    while True:
+        # The call frame holds IT, the params and the other variables of the
+        # function, and points back to the caller
+        funcEnv = Env(function.layout,
+                      [None] + args + [unset] * function.nlocals, env)
+
+        # Evaluate the function body until a statement leaves it
+        for stmt in function.body:
+            done = statement[stmt.__class__](stmt, funcEnv)
+            if done is not None:
+                break
+        else:
+            break
+        if done is returned:
+            result = funcEnv.slots[0]
+            break
+
+        # FOUND YR a call: make it in place of this one, without this frame
+        # unless some function could look up its variables. Only this
+        # call's result is remembered.
+        if not unseen(funcEnv):
+            env = funcEnv
+        function, args = funcEnv.slots[0]
+        if limited:
+            tick()
+    if memo is not None:
+        memo.put(key, result)
+    return result
+
+def neg(node, env=global_env):
+    return not expression(node.value, env)
+
+def allOf(node, env=global_env):
+    if strict:
+        return all([expression(arg, env) for arg in node.args])
+    # Stop at the first argument which is false
+    for arg in node.args:
+        if not exp[arg.__class__](arg, env):
+            return False
+    return True
+
+def anyOf(node, env=global_env):
+    if strict:
+        return any([expression(arg, env) for arg in node.args])
+    # Stop at the first argument which is true
+    for arg in node.args:
+        if exp[arg.__class__](arg, env):
+            return True
+    return False
+
+def cast(node, env=global_env):
+    try:
+        return types[node.type](expression(node.value, env))
     except (AttributeError, KeyError, IndexError, TypeError):
-        print("Error: invalid cast.")
+        print("Error: invalid cast.", file=programOutput)
         sys.exit(1)
 
 #--------------------------------------------------------------------------
 # Math Operations and Comparisons
 #--------------------------------------------------------------------------
 
-def equals(env=global_env):
-    #print('equals')
-    try:
-        if (code[0].popleft() != 'BOTH' or code[0].popleft() != 'SAEM'):
-            raise IndexError
+# The shortest YARN which adding to a variable builds up in a Yarn
+yarnMin = 256
+
+class Yarn:
+    """
+    A YARN built up by adding to a variable over and over, as in
+    s R SUM OF s AN "more". The text goes on the end of a buffer, which it
+    shares with the YARNs it was built from, so adding to it takes O(1) time
+    and it is only joined up into a str when it is printed, compared or used
+    in any other way, as that str.
+    """
+    __slots__ = ('buffer', 'length', 'text')
+
+    def __init__(self, buffer, length):
+        self.buffer, self.length, self.text = buffer, length, None
+
+    def add(self, more):
+        "This YARN with more on the end."
+        buffer = self.buffer
+        if buffer.tell() != self.length:    # Another YARN was built on it
+            buffer = io.StringIO()
+            buffer.write(str(self))
+        buffer.write(more)
+        return Yarn(buffer, self.length + len(more))
 
-        # Get arguments
-        x, y = getBinArgs(env)
-   
-        return x == y
-    except IndexError:
-        print("Error: invalid equals comparison.")
+    def __str__(self):
+        if self.text is None:
+            text = self.buffer.getvalue()
+            self.text = text[:self.length] if len(text) > self.length else text
+        return self.text
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __add__(self, other):
+        if other.__class__ is str:
+            return self.add(other)
+        return str(self) + other
+
+    def __radd__(self, other):
+        return other + str(self)
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __len__(self):
+        return self.length
+
+    def __hash__(self):
+        return hash(str(self))
+
+    # Python calls these either way round, e.g. x.__lt__(y) for y > x, so
+    # for other types they leave the error to Python, which then names the
+    # operator and operands in the order they were written
+    def __lt__(self, other):
+        if other.__class__ is str or other.__class__ is Yarn:
+            return str(self) < str(other)
+        return NotImplemented
+
+    def __le__(self, other):
+        if other.__class__ is str or other.__class__ is Yarn:
+            return str(self) <= str(other)
+        return NotImplemented
+
+    def __gt__(self, other):
+        if other.__class__ is str or other.__class__ is Yarn:
+            return str(self) > str(other)
+        return NotImplemented
+
+    def __ge__(self, other):
+        if other.__class__ is str or other.__class__ is Yarn:
+            return str(self) >= str(other)
+        return NotImplemented
+
+    def __eq__(self, other): return str(self) == other
+    def __ne__(self, other): return str(self) != other
+    def __int__(self): return int(str(self))
+    def __float__(self): return float(str(self))
+    def __sub__(self, other): return str(self) - other
+    def __rsub__(self, other): return other - str(self)
+    def __mul__(self, other): return str(self) * other
+    def __rmul__(self, other): return other * str(self)
+    def __truediv__(self, other): return str(self) / other
+    def __rtruediv__(self, other): return other / str(self)
+    def __mod__(self, other): return str(self) % other
+    def __rmod__(self, other): return other % str(self)
+
+Yarn.__name__ = 'str'   # What errors call the type of its values
+
+def append(x, y):
+    """
+    Add y to the value of a variable, x, as SUM OF does, building up YARNs
+    long enough to be worth it in a Yarn.
+    """
+    if y.__class__ is str:
+        if x.__class__ is Yarn:
+            return x.add(y)
+        elif x.__class__ is str and len(x) + len(y) >= yarnMin:
+            buffer = io.StringIO()
+            buffer.write(x)
+            buffer.write(y)
+            return Yarn(buffer, len(x) + len(y))
+    return x + y
+
+binops = { 'BOTH SAEM':operator.eq, 'DIFFRINT':operator.ne, 'BIGGR OF':max,
+           'SMALLR OF':min, 'SUM OF':operator.add, 'DIFF OF':operator.sub,
+           'PRODUKT OF':operator.mul, 'QUOSHUNT OF':operator.truediv,
+           'MOD OF':operator.mod, 'APPEND':append }
+
+def binOp(node, env=global_env):
+    site = node.site
+    if site is not None:
+        return site.run(node, env)
+    return binops[node.op](expression(node.left, env),
+                           expression(node.right, env))
+
+def literal(node, env=global_env):
+    return node.value
+
+def variable(node, env=global_env):
+    scope = env.find(node.name)
+    if scope is None:   # Not a variable, so it is not a valid value
+        print("Error: invalid YARN.", file=programOutput)
         sys.exit(1)
+    return scope.slots[scope.layout[node.name]]
 
-def notEquals(env=global_env):
-    try:
-        if (code[0].popleft() != 'DIFFRINT'):
-            raise IndexError
+def local(node, env=global_env):
+    return env.slots[node.index]
 
-        # Get arguments
-        x, y = getBinArgs(env)
-            
-        return (x != y)
-    except IndexError:
-        print("Error: invalid not equals comparison.")
+def globalVar(node, env=global_env):
+    value = global_env.slots[node.index]
+    if value is unset:  # Not a variable, so it is not a valid value
+        print("Error: invalid YARN.", file=programOutput)
         sys.exit(1)
+    return value
 
-def greater(env=global_env):
-    try:
-        if (code[0].popleft() != 'BIGGR' or code[0].popleft() != 'OF'):
-            raise IndexError
+#--------------------------------------------------------------------------
+# Quickening
+#--------------------------------------------------------------------------
 
-        # Get arguments
-        x, y = getBinArgs(env)
-            
-        return max(x, y)
-    except IndexError:
-        print("Error: invalid greater than comparison.")
-        sys.exit(1)
+# Runs with the same types of operand before an operation is quickened
+quickenAfter = 16
+# Times an operation is quickened before it is left to learnOp for good
+quickenMax = 4
+
+class Site(object):
+    """
+    How an arithmetic or comparison operation in the parse tree is run. It
+    starts off run by learnOp, which notes the types of its operands. Once
+    they have been the same quickenAfter times in a row it is run by a
+    handler made for those types and the kinds of its operands, which
+    evaluates them directly and applies the Python operator to them. When
+    an operand has another type the handler misses, and learnOp takes over
+    again until the types settle.
+    """
+    __slots__ = ('run', 'node', 'types', 'seen', 'quickened', 'hits',
+                 'misses', 'slow')
 
-def less(env=global_env):
-    try:
-        if (code[0].popleft() != 'SMALLR' or code[0].popleft() != 'OF'):
-            raise IndexError
+    def __init__(self):
+        self.run = learnOp
+        self.node = None        # The operation, once it has run
+        self.types = None       # The types of its operands last time
+        self.seen = 0           # Runs in a row with those types
+        self.quickened = 0      # Handlers made for it
+        self.hits = self.misses = self.slow = 0
+        if siteStats:
+            siteTables.append(self)
+
+# Every Site made, for the statistics
+siteTables = []
+
+def newSite(op):
+    "The Site of a new operation, or None if it is not quickened."
+    if not quickening or op == 'APPEND':   # append has its own YARN paths
+        return None
+    return Site()
+
+def learnOp(node, env=global_env):
+    "Run an operation, quickening it once the types of its operands settle."
+    left, right = node.left, node.right
+    x = exp[left.__class__](left, env)
+    y = exp[right.__class__](right, env)
+    site = node.site
+    types = (x.__class__, y.__class__)
+    if types == site.types:
+        site.seen += 1
+        if site.seen == quickenAfter and site.quickened < quickenMax:
+            site.quickened += 1
+            site.run = quickened(node, types)
+    else:
+        site.types, site.seen = types, 1
+    if siteStats:
+        site.node = node
+        site.slow += 1
+    return binops[node.op](x, y)
+
+def missOp(node, x, y):
+    "Run an operation its handler was not made for, and learn again."
+    site = node.site
+    site.misses += 1
+    site.run = learnOp
+    site.types, site.seen = (x.__class__, y.__class__), 1
+    return binops[node.op](x, y)
+
+# Makers of handlers, by op, operand kinds, operand types and whether they
+# count their hits. Each has code of its own, which Python specializes for
+# the types it is made for.
+handlerMakers = {}
+
+def operandKind(node):
+    "How a handler evaluates an operand: a constant, a slot or otherwise."
+    kind = node.__class__
+    if kind is Literal:
+        return 'constant'
+    elif kind is Local:
+        return 'slot'
+    return 'expression'
+
+def makeHandlerMaker(op, kinds, counting):
+    """
+    Compile a function making handlers for an operation with operands of
+    the given kinds, which checks the types of the operands that are not
+    constants.
+    """
+    lines = ['def make(site, a, b, ta, tb):',
+             '    def run(node, env):']
+    guards = []
+    for name, kind, arg, type in (('x', kinds[0], 'a', 'ta'),
+                                  ('y', kinds[1], 'b', 'tb')):
+        if kind == 'constant':
+            lines.append('        %s = %s' % (name, arg))
+            continue
+        elif kind == 'slot':
+            lines.append('        %s = env.slots[%s]' % (name, arg))
+        else:
+            lines.append('        %s = _exp[%s.__class__](%s, env)' %
+                         (name, arg, arg))
+        guards.append('%s.__class__ is %s' % (name, type))
+    if op in pyBinops:
+        value = 'x %s y' % pyBinops[op]
+    else:
+        value = '%s(x, y)' % pyBinopFuncs[op]
+
+    pad = '        '
+    if guards:
+        lines.append(pad + 'if %s:' % ' and '.join(guards))
+        pad += '    '
+    if counting:
+        lines.append(pad + 'site.hits += 1')
+    lines.append(pad + 'return ' + value)
+    if guards:
+        lines.append('        return _miss(node, x, y)')
+    lines.append('    return run')
+
+    namespace = { '_exp':exp, '_miss':missOp }
+    exec(compile('\n'.join(lines) + '\n', '<quickened %s>' % op, 'exec'),
+         namespace)
+    return namespace['make']
+
+def quickened(node, types):
+    "A handler for an operation whose operands have the given types."
+    left, right = node.left, node.right
+    kinds = (operandKind(left), operandKind(right))
+    key = (node.op, kinds, types, siteStats)
+    maker = handlerMakers.get(key)
+    if maker is None:
+        maker = handlerMakers[key] = makeHandlerMaker(node.op, kinds,
+                                                      siteStats)
+    args = [operand.value if kind == 'constant' else
+            operand.index if kind == 'slot' else operand
+            for operand, kind in zip((left, right), kinds)]
+    return maker(node.site, args[0], args[1], types[0], types[1])
+
+# The LOLCODE names of the types of values
+typeNames = { bool:'TROOF', int:'NUMBR', float:'NUMBAR', str:'YARN',
+              Yarn:'YARN', type(None):'NOOB' }
+
+def operandText(node):
+    "An operand as it is written in LOLCODE, without any operands of its own."
+    kind = node.__class__
+    if kind is Literal:
+        value = node.value
+        if value.__class__ is str:
+            return '"%s"' % value
+        elif value.__class__ is bool:
+            return 'WIN' if value else 'FAIL'
+        elif value is None:
+            return 'NOOB'
+        return repr(value)
+    elif kind is Var or kind is Local or kind is Global:
+        return node.name
+    elif kind is BinOp:
+        return node.op + ' ...'
+    elif kind is Call:
+        return node.name + ' ... MKAY?'
+    return '...'
+
+def reportSites(file):
+    """
+    Write how often each operation which ran was run by its handler (hits),
+    how often its handler missed and how often it ran otherwise.
+    """
+    file.write('%-32s %-16s %10s %10s %10s %8s %5s\n' %
+               ('operation', 'types', 'hits', 'misses', 'slow', 'hit %',
+                'quick'))
+    for site in siteTables:
+        node = site.node
+        if node is None:
+            continue
+        runs = site.hits + site.misses + site.slow
+        text = '%s %s AN %s' % (node.op, operandText(node.left),
+                                operandText(node.right))
+        types = ' '.join(typeNames.get(type, type.__name__)
+                         for type in site.types)
+        file.write('%-32s %-16s %10d %10d %10d %8.1f %5d\n' %
+                   (text[:32], types, site.hits, site.misses, site.slow,
+                    site.hits * 100 / runs, site.quickened))
 
-        # Get arguments
-        x, y = getBinArgs(env)
-            
-        return min(x, y)
-    except IndexError:
-        print("Error: invalid less than comparison.")
-        sys.exit(1)
+#--------------------------------------------------------------------------
+# Main Expression Evaluation Function
+#--------------------------------------------------------------------------
 
-def add(env=global_env):
-    try:
-        if (code[0].popleft() != 'SUM' or code[0].popleft() != 'OF'):
-            raise IndexError
+# Create expression dispatch dictionary
+exp = { Literal:literal, Var:variable, Local:local, Global:globalVar,
+        Call:funcEval, BinOp:binOp, Not:neg,
+        AllOf:allOf, AnyOf:anyOf, Cast:cast }
 
-        # Get arguments
-        x, y = getBinArgs(env)
-            
-        return x + y
-    except IndexError:
-        print("Error: invalid addition operation.")
-        sys.exit(1)
+def expression(node, env=global_env):
+    return exp[node.__class__](node, env)
 
-def sub(env=global_env):
-    try:
-        if (code[0].popleft() != 'DIFF' or code[0].popleft() != 'OF'):
-            raise IndexError
+#--------------------------------------------------------------------------
+# Python Code Generation
+#--------------------------------------------------------------------------
 
-        # Get arguments
-        x, y = getBinArgs(env)
-            
-        return x - y
-    except IndexError:
-        print("Error: invalid subtraction operation.")
+# How the variables of a function (or the main program) are generated:
+#   safe     - variables resolved to a Local slot
+#   pyLocals - the safe variables which no function looks up by name, so
+#              they become Python locals rather than slots of the frame
+#   layout   - {'var':index} of the slots in the call frame
+PyScope = namedtuple('PyScope', 'safe pyLocals layout inFunction')
+
+# IT is always the first slot of the current frame
+frameIT = Local('IT', 0)
+
+def blockVars(body):
+    "Yield every variable read or written by a block outside of functions."
+    for node in body:
+        kind = node.__class__
+        if kind is Loop:
+            yield from expVars(node.cond)
+            yield from blockVars(node.body)
+        elif kind is IfBlock:
+            yield from blockVars(node.body)
+            for cond, body in node.arms:
+                if cond is not None:
+                    yield from expVars(cond)
+                yield from blockVars(body)
+        elif kind is Print:
+            for arg in node.args:
+                yield from expVars(arg)
+        elif kind is Input:
+            yield node.var
+        elif kind is Assign or kind is Declare:
+            yield node.var
+            if node.value is not None:
+                yield from expVars(node.value)
+        elif kind is Found or kind is ExpStatement:
+            yield from expVars(node.value)
+
+def pyName(name):
+    "The Python identifier used for a LOLCODE variable."
+    if name.isidentifier() and name.isascii():
+        return 'lol_' + name
+    return 'lolx_' + '_'.join('%x' % ord(c) for c in name)
+
+def pyLiteral(value):
+    if value.__class__ is float and not math.isfinite(value):
+        return 'float(%r)' % repr(value)    # inf and nan have no literal
+    return repr(value)
+
+# Python operators for the binary operators which have one
+pyBinops = { 'BOTH SAEM':'==', 'DIFFRINT':'!=', 'SUM OF':'+', 'DIFF OF':'-',
+             'PRODUKT OF':'*', 'QUOSHUNT OF':'/', 'MOD OF':'%' }
+
+# Functions implementing the other binary operators in generated code
+pyBinopFuncs = { 'BIGGR OF':'max', 'SMALLR OF':'min', 'APPEND':'_append' }
+
+def genVar(var, scope):
+    "Generate the Python expression reading a variable."
+    kind = var.__class__
+    if kind is Local:
+        if var.name in scope.pyLocals:
+            return pyName(var.name)
+        return '_s[%d]' % var.index
+    elif kind is Global:
+        return '(_g[%d] if _g[%d] is not _unset else _undefined())' % (
+            var.index, var.index)
+    return '_lookup(_f, %r)' % var.name
+
+def genExp(node, scope, gen):
+    "Generate the Python expression computing the value of node."
+    kind = node.__class__
+    if kind is Literal:
+        return pyLiteral(node.value)
+    elif kind is Var or kind is Local or kind is Global:
+        return genVar(node, scope)
+    elif kind is BinOp:
+        x = genExp(node.left, scope, gen)
+        y = genExp(node.right, scope, gen)
+        if node.op in pyBinops:
+            return '(%s %s %s)' % (x, pyBinops[node.op], y)
+        return '%s(%s, %s)' % (pyBinopFuncs[node.op], x, y)
+    elif kind is Not:
+        return '(not %s)' % genExp(node.value, scope, gen)
+    elif kind is AllOf or kind is AnyOf:
+        args = [genExp(arg, scope, gen) for arg in node.args]
+        if strict:
+            return '%s([%s])' % ('all' if kind is AllOf else 'any',
+                                 ''.join(arg + ', ' for arg in args))
+        elif not args:
+            return repr(kind is AllOf)
+        # Python's and and or stop at the operand deciding the result
+        return '(True if %s else False)' % (
+            ' and ' if kind is AllOf else ' or ').join(args)
+    elif kind is Cast:
+        value = genExp(node.value, scope, gen)
+        if node.value.__class__ not in (Literal, Var, Local, Global):
+            # Errors raised by the operand are reported as an invalid cast
+            value = '(lambda: %s)' % value
+        return '_cast(%r, %s)' % (node.type, value)
+    elif kind is Call:
+        args = ''.join(', ' + genExp(arg, scope, gen) for arg in node.args)
+        if gen['arity'].get(node.name) == len(node.args):
+            return '_getfunc(%r)(_f%s)' % (node.name, args)
+        return '_call(_getfunc(%r), _f%s)' % (node.name, args)
+
+def genStore(var, value, scope):
+    "Generate the statement storing value into an existing variable."
+    kind = var.__class__
+    if kind is Local:
+        if var.name in scope.pyLocals:
+            return '%s = %s' % (pyName(var.name), value)
+        return '_s[%d] = %s' % (var.index, value)
+    elif kind is Global:
+        return '_g[%d] = %s' % (var.index, value)
+    return '_assign(_f, %r, %s)' % (var.name, value)
+
+def genBlock(body, scope, gen, indent):
+    "Generate the Python statements for a block into gen['lines']."
+    lines = gen['lines']
+    start = len(lines)
+    pad = '    ' * indent
+    for node in body:
+        kind = node.__class__
+        if kind is Loop:
+            lines.append(pad + 'while %s:' % genExp(node.cond, scope, gen))
+            if limited:
+                lines.append(pad + '    _tick()')
+            gen['loops'] += 1
+            genBlock(node.body, scope, gen, indent + 1)
+            gen['loops'] -= 1
+        elif kind is IfBlock and node.table is not None:
+            lines.append(pad + 'if %s:' % genVar(frameIT, scope))
+            genBlock(node.body, scope, gen, indent + 1)
+            lines.append(pad + 'else:')
+            genSwitch(node, scope, gen, indent + 1)
+        elif kind is IfBlock:
+            lines.append(pad + 'if %s:' % genVar(frameIT, scope))
+            genBlock(node.body, scope, gen, indent + 1)
+            for cond, arm in node.arms:
+                if cond is None:
+                    lines.append(pad + 'else:')
+                else:
+                    lines.append(pad + 'elif %s == True:' %
+                                 genExp(cond, scope, gen))
+                genBlock(arm, scope, gen, indent + 1)
+        elif kind is FuncDecl:
+            lines.append(pad + '_func[%r] = %s' %
+                         (node.name, gen['names'][id(node)]))
+        elif kind is Print:
+            args = ''.join(genExp(arg, scope, gen) + ', ' for arg in node.args)
+            lines.append(pad + '_visible([%s])' % args)
+        elif kind is Input:
+            if node.var.__class__ is Local:
+                lines.append(pad + genStore(node.var, '_input()', scope))
+            else:
+                lines.append(pad + '_gimmeh(_f, %r)' % node.var.name)
+        elif kind is Assign:
+            lines.append(pad + genStore(node.var,
+                                        genExp(node.value, scope, gen), scope))
+        elif kind is Declare:
+            value = 'None'
+            if node.value is not None:
+                value = genExp(node.value, scope, gen)
+            var = node.var
+            if var.__class__ is Var:
+                # Declared in the current frame
+                var = Local(var.name, scope.layout[var.name])
+                lines.append(pad + '_declare(_s, %d)' % var.index)
+            elif var.__class__ is Global:
+                lines.append(pad + '_declare(_g, %d)' % var.index)
+            lines.append(pad + genStore(var, value, scope))
+        elif (kind is Found and gen['tail'] is not None and
+              not gen['loops'] and isTailCall(node, gen['tail'][0])):
+            # Call the function again by going round its loop
+            function, seen = gen['tail']
+            if function.params:
+                lines.append(pad + '%s = %s' % (
+                    ', '.join(pyName(param) for param in function.params),
+                    ', '.join(genExp(arg, scope, gen)
+                              for arg in node.value.args)))
+            if seen:
+                lines.append(pad + 'if %s:' % ' or '.join(
+                    '_s[%d] is not _unset' % index for index in seen))
+                lines.append(pad + '    _env = _f')
+            lines.append(pad + 'continue')
+        elif kind is Found:
+            value = genExp(node.value, scope, gen)
+            if scope.inFunction:
+                lines.append(pad + 'return %s' % value)
+            else:
+                lines.append(pad + 'raise _Found(%s)' % value)
+        elif kind is ExpStatement:
+            value = genExp(node.value, scope, gen)
+            lines.append(pad + genStore(frameIT, value, scope))
+        elif kind is Error:
+            lines.append(pad + '_error(%r)' % node.message)
+    if len(lines) == start:
+        lines.append(pad + 'pass')
+
+def genSwitch(node, scope, gen, indent):
+    """
+    Generate the lookup of the MEBBE arm of an O RLY? block with a table, and
+    a binary search for the code of that arm.
+    """
+    var, cases, default = node.table
+    name = 'loltable_%d' % len(gen['tables'])
+    gen['tables'].append('%s = {%s}' % (name, ', '.join(
+        '%s:%d' % (pyLiteral(value), index)
+        for value, index in cases.items())))
+    arms = [arm for cond, arm in node.arms]
+    if default is None:     # Nothing to do unless an arm is found
+        default = len(arms)
+        arms.append(())
+    gen['lines'].append('    ' * indent + '_k = %s.get(%s, %d)' %
+                        (name, genVar(var, scope), default))
+
+    def search(start, end, indent):
+        if end - start == 1:
+            genBlock(arms[start], scope, gen, indent)
+            return
+        middle = (start + end) // 2
+        gen['lines'].append('    ' * indent + 'if _k < %d:' % middle)
+        search(start, middle, indent + 1)
+        gen['lines'].append('    ' * indent + 'else:')
+        search(middle, end, indent + 1)
+    search(0, len(arms), indent)
+
+def isTailCall(node, function):
+    "Whether a FOUND YR statement calls function with all its params."
+    value = node.value
+    return (value.__class__ is Call and value.name == function.name and
+            len(value.args) == len(function.params))
+
+def tailCalls(function):
+    "Whether a function body calls itself in FOUND YR outside of loops."
+    def visit(body):
+        for node in body:
+            kind = node.__class__
+            if kind is Found and isTailCall(node, function):
+                return True
+            elif kind is IfBlock and (visit(node.body) or
+                                      any(visit(arm)
+                                          for cond, arm in node.arms)):
+                return True
+        return False
+    return visit(function.body)
+
+def genFunction(node, shared, gen):
+    "Generate the Python function for a function declaration."
+    safe = safeNames(node.params, node.body)
+    scope = PyScope(safe, safe - shared, node.layout, True)
+    lines = gen['lines']
+    name = gen['names'][id(node)]
+    args = ''.join(', ' + pyName(param) for param in node.params)
+    lines.append('def %s(_env%s):' % (name, args))
+
+    # A call frame is only needed if some variable is kept in its slots
+    fresh = bool(safe & shared) or 'IT' not in safe or any(
+        var.__class__ is Var for var in blockVars(node.body))
+
+    # A function only ever declared once, which calls itself in FOUND YR,
+    # can do so by going round a loop. The next frame points back to this
+    # one only if other functions may find its variables in it. What it
+    # finds is only remembered once.
+    indent = 1
+    gen['tail'] = None
+    if gen['once'].get(node.name) and tailCalls(node):
+        seen = sorted(node.layout[name] for name in shared
+                      if fresh and name in node.layout)
+        gen['tail'] = node, seen
+        lines.append('    while True:')
+        indent = 2
+    pad = '    ' * indent
+    if fresh:
+        # The call frame holds IT, the params and the other variables of the
+        # function, and points back to the caller
+        lines.append(pad + '_f = Env(%s, [None%s] + [_unset] * %d, _env)' %
+                     (gen['layouts'][id(node)], args, node.nlocals))
+        lines.append(pad + '_s = _f.slots')
+    else:
+        lines.append(pad + '_f = _env')
+    if 'IT' in scope.pyLocals:
+        lines.append(pad + 'lol_IT = None')
+    if limited:
+        lines.append(pad + '_tick()')
+    genBlock(node.body, scope, gen, indent)
+    if gen['tail'] is not None:
+        lines.append(pad + 'return None')
+        gen['tail'] = None
+    lines.append('%s.nparams = %d' % (name, len(node.params)))
+    if node.pure:
+        lines.append('%s = _memo(%s, %r)' % (name, name, node.name))
+
+def genProgram(body, layout=globalLayout):
+    "Translate a resolved program into the source of a Python module."
+    decls = list(funcDecls(body))
+
+    # Variables a function may look up outside of its own frame
+    shared = set()
+    for node in decls:
+        shared.update(var.name for var in blockVars(node.body)
+                      if var.__class__ is not Local)
+
+    # Functions which always take the same number of arguments
+    arity = {}
+    for node in decls:
+        if arity.setdefault(node.name, len(node.params)) != len(node.params):
+            arity[node.name] = None
+
+    # Functions declared just once
+    once = {}
+    for node in decls:
+        once[node.name] = node.name not in once
+
+    gen = { 'lines':[], 'tables':[], 'arity':arity, 'once':once,
+            'tail':None, 'loops':0,
+            'names':{ id(node):'lolfunc_%d' % i
+                      for i, node in enumerate(decls) },
+            'layouts':{ id(node):'lollayout_%d' % i
+                        for i, node in enumerate(decls) } }
+    for node in decls:
+        gen['lines'].append('%s = %r' % (gen['layouts'][id(node)],
+                                         node.layout))
+        genFunction(node, shared, gen)
+
+    safe = safeNames((), body)
+    scope = PyScope(safe, safe - shared, layout, False)
+    gen['lines'].append('def lolmain(_f):')
+    gen['lines'].append('    _s = _f.slots')
+    if 'IT' in scope.pyLocals:
+        gen['lines'].append('    lol_IT = None')
+    genBlock(body, scope, gen, 1)
+    return '\n'.join(gen['tables'] + gen['lines']) + '\n'
+
+#--------------------------------------------------------------------------
+# Runtime Support for Generated Code
+#--------------------------------------------------------------------------
+
+def lookup(env, name):
+    "Find the value of a variable through the chain of call frames."
+    scope = env.find(name)
+    if scope is None:
+        undefined()
+    return scope.slots[scope.layout[name]]
+
+def undefined():
+    "Report a variable which has not been declared."
+    print("Error: invalid YARN.", file=programOutput)
+    sys.exit(1)
+
+def assign(env, name, value):
+    "Assign a variable as the R statement does."
+    # Not previously defined, so it is defined in the current frame
+    scope = env.find(name) or env
+    scope.slots[scope.layout[name]] = value
+
+def declare(slots, index):
+    "Check that the variable in a slot of a frame may be declared."
+    if slots[index] is not unset:
+        print("Error: Invalid declaration.", file=programOutput)
         sys.exit(1)
 
-def mul(env=global_env):
-    try:
-        if (code[0].popleft() != 'PRODUKT' or code[0].popleft() != 'OF'):
-            raise IndexError
-        
-        # Get arguments
-        x, y = getBinArgs(env)
-            
-        return x * y
-    except IndexError:
-        print("Error: invalid multiplication operation.")
+def gimmeh(env, name):
+    "Read input into a variable as the GIMMEH statement does."
+    val = readValue()
+    scope = env.find(name)
+    if scope is None:   # Variable is not defined
+        print("Error: invalid GIMMEH statement.", file=programOutput)
         sys.exit(1)
+    scope.slots[scope.layout[name]] = val
 
-def div(env=global_env):
+def castValue(type, value):
+    "Cast a value, or the result of calling value, as MAEK does."
     try:
-        if (code[0].popleft() != 'QUOSHUNT' or code[0].popleft() != 'OF'):
-            raise IndexError
-
-        # Get arguments
-        x, y = getBinArgs(env)
-            
-        return x / y
-    except IndexError:
-        print("Error: invalid division operation.")
+        if callable(value):
+            value = value()
+        return types[type](value)
+    except (AttributeError, KeyError, IndexError, TypeError):
+        print("Error: invalid cast.", file=programOutput)
         sys.exit(1)
 
-def mod(env=global_env):
+def callCompiled(function, env, *args):
+    "Call a generated function after checking the number of arguments."
+    if len(args) != function.nparams:
+        print("Error: invalid number of arguments in function call.",
+              file=programOutput)
+        sys.exit(1)
+    return function(env, *args)
+
+def compileProgram(body):
+    """
+    Compile a parsed program into a Python code object. Returns None if
+    Python cannot compile the generated source, e.g. when blocks are nested
+    too deeply, in which case the tree should be evaluated instead.
+    """
     try:
-        if (code[0].popleft() != 'MOD' or code[0].popleft() != 'OF'):
-            raise IndexError
+        return compile(genProgram(body), '<lolcode>', 'exec')
+    except (SyntaxError, RecursionError, MemoryError):
+        return None
 
-        # Get arguments
-        x, y = getBinArgs(env)
-            
-        return x % y
-    except IndexError:
-        print("Error: invalid modulo operation.")
-        sys.exit(1)
+def runCompiled(codeobj, env=global_env):
+    "Run a compiled program in the given global environment."
+    functions = {}
+
+    def getfunc(name):
+        try:
+            return functions[name]
+        except KeyError:    # Not declared yet, so it is not a valid value
+            print("Error: invalid YARN.", file=programOutput)
+            sys.exit(1)
+
+    namespace = { 'Env':Env, '_unset':unset, '_g':env.slots,
+                  '_undefined':undefined, '_func':functions,
+                  '_getfunc':getfunc, '_call':callCompiled, '_lookup':lookup,
+                  '_assign':assign, '_declare':declare, '_gimmeh':gimmeh,
+                  '_input':readValue, '_visible':visible, '_cast':castValue,
+                  '_append':append, '_Found':FoundException,
+                  '_memo':memoized, '_tick':tick,
+                  '_error':lambda message: error(Error(message)) }
+    exec(codeobj, namespace)
+    namespace['lolmain'](env)
+
+#--------------------------------------------------------------------------
+# Virtual Machine
+#--------------------------------------------------------------------------
+
+# The instructions of a function or the main program, each an (op, arg)
+# pair, and the (start, end) ranges of them whose errors are reported as
+# an invalid cast
+Unit = namedtuple('Unit', 'code casts')
+
+# The operations of the machine. Calls are taken apart into operations on
+# a stack of operands, while expressions without calls are evaluated by the
+# tree walker in a single operation, as their depth is limited by the
+# source and not by how deeply the program recurses.
+opEval = 0          # Push the value of expression arg
+opSet = 1           # Set slot arg[0] of the current frame to expression arg[1]
+opSetGlobal = 2     # Set slot arg[0] of the main program to expression arg[1]
+opTest = 3          # Go to arg[1] if expression arg[0] is false
+opTestTrue = 4      # Go to arg[1] unless expression arg[0] equals WIN
+opTestIT = 5        # Go to arg if IT is false
+opJump = 6          # Go to instruction arg
+opVisible = 7       # Print the values of the expressions in arg
+opReturnValue = 8   # Return the value of expression arg to the caller
+opFunc = 9          # Push the function named arg, as it is declared now
+opCall = 10         # Pop arg args and a function, and call it with them
+opReturn = 11       # Pop a value and return it to the caller
+opStore = 12        # Pop into slot arg of the current frame
+opStoreGlobal = 13  # Pop into slot arg of the main program's frame
+opAssign = 14       # Pop into the variable named arg, as R does
+opJumpIfFalse = 15  # Pop a value and go to arg if it is false
+opJumpUnlessTrue = 16   # Pop a value and go to arg unless it equals WIN
+opBinOp = 17        # Pop y and x, push arg(x, y)
+opNot = 18          # Pop a value and push its negation
+opAllOf = 19        # Pop arg values, push whether they are all true
+opAnyOf = 20        # Pop arg values, push whether any of them is true
+opCast = 21         # Pop a value and push it cast to type arg
+opPrint = 22        # Pop arg values and print them
+opInput = 23        # Read input into slot arg of the current frame
+opGimmeh = 24       # Read input into the variable named arg
+opDeclare = 25      # Check slot arg of the current frame may be declared
+opDeclareGlobal = 26    # Check slot arg of the main program may be declared
+opFuncDecl = 27     # Declare the function arg, a (FuncDecl, Unit) pair
+opError = 28        # Report the error message arg
+opHalt = 29         # End the main program
+opTick = 30         # Count a step, when the program's steps are limited
+opSwitch = 31       # Go to where arg[1] maps the value of variable arg[0],
+                    # or to arg[2] if it has no entry
+opDecide = 32       # Pop a value, and if its truth is arg[0], push arg[0]
+                    # and go to arg[1]
+opTailCall = 33     # Call as opCall does, in place of the current call
+opCount = 34        # Add arg[2] to the NUMBR counter arg[0] (of the main
+                    # program if arg[1]) and go to arg[4] unless it equals
+                    # the NUMBR bound arg[3], or to arg[5] once it does
+
+def hasCall(node):
+    "Whether an expression calls a function."
+    return next(expCalls(node), None) is not None
+
+def asmExp(node, unit):
+    "Append the instructions pushing the value of an expression to unit."
+    code = unit.code
+    kind = node.__class__
+    if not hasCall(node):
+        code.append((opEval, node))
+    elif kind is BinOp:
+        asmExp(node.left, unit)
+        asmExp(node.right, unit)
+        code.append((opBinOp, binops[node.op]))
+    elif kind is Not:
+        asmExp(node.value, unit)
+        code.append((opNot, None))
+    elif (kind is AllOf or kind is AnyOf) and not strict:
+        # Test each argument in turn, going to the end with the result once
+        # one decides it
+        decides = kind is AnyOf
+        tests = []
+        for arg in node.args:
+            asmExp(arg, unit)
+            tests.append(len(code))
+            code.append((opDecide, None))
+        code.append((opEval, Literal(not decides)))
+        for test in tests:
+            code[test] = (opDecide, (decides, len(code)))
+    elif kind is AllOf or kind is AnyOf:
+        for arg in node.args:
+            asmExp(arg, unit)
+        code.append((opAllOf if kind is AllOf else opAnyOf, len(node.args)))
+    elif kind is Cast:
+        start = len(code)
+        asmExp(node.value, unit)
+        code.append((opCast, node.type))
+        unit.casts.append((start, len(code)))
+    elif kind is Call:
+        # The function is looked up before its args are evaluated
+        code.append((opFunc, node.name))
+        for arg in node.args:
+            asmExp(arg, unit)
+        code.append((opCall, len(node.args)))
+
+def asmStore(var, value, unit):
+    "Append the instructions setting a variable to the value of an expression."
+    code = unit.code
+    kind = var.__class__
+    if not hasCall(value) and (kind is Local or kind is Global):
+        code.append((opSet if kind is Local else opSetGlobal,
+                     (var.index, value)))
+        return
+
+    asmExp(value, unit)
+    if kind is Local:
+        code.append((opStore, var.index))
+    elif kind is Global:
+        code.append((opStoreGlobal, var.index))
+    else:
+        code.append((opAssign, var.name))
+
+def asmTest(cond, unit, whenTrue=False):
+    """
+    Append the instructions going past the next ones if cond is false (or
+    unless it equals WIN, as MEBBE tests). Returns the index of the
+    instruction to fill in with where to go once that is known.
+    """
+    code = unit.code
+    if hasCall(cond):
+        asmExp(cond, unit)
+        code.append((opJumpUnlessTrue if whenTrue else opJumpIfFalse, None))
+    else:
+        code.append((opTestTrue if whenTrue else opTest, (cond, None)))
+    return len(code) - 1
+
+def patch(unit, index):
+    "Make the jump or test at index go to the end of the instructions."
+    op, arg = unit.code[index]
+    if op == opTest or op == opTestTrue:
+        unit.code[index] = (op, (arg[0], len(unit.code)))
+    else:
+        unit.code[index] = (op, len(unit.code))
+
+def asmBlock(body, unit, layout):
+    "Append the instructions of a block, in a frame laid out by layout."
+    code = unit.code
+    for node in body:
+        kind = node.__class__
+        if kind is Profile:
+            node = node.node
+            kind = node.__class__
+        if kind is Loop and node.count is not None:
+            # Step the counter and test it with one instruction, which goes
+            # on to the usual increment and test unless both are NUMBRs
+            counter, step, bound = node.count
+            top = len(code)
+            test = asmTest(node.cond, unit)
+            if limited:
+                code.append((opTick, None))
+            asmBlock(node.body[:-1], unit, layout)
+            count = len(code)
+            code.append((opCount, None))
+            asmBlock(node.body[-1:], unit, layout)
+            code.append((opJump, top))
+            patch(unit, test)
+            code[count] = (opCount, (counter.index,
+                                     counter.__class__ is Global, step,
+                                     bound, test + 1, len(code)))
+        elif kind is Loop:
+            top = len(code)
+            test = asmTest(node.cond, unit)
+            if limited:
+                code.append((opTick, None))
+            asmBlock(node.body, unit, layout)
+            code.append((opJump, top))
+            patch(unit, test)
+        elif kind is IfBlock and node.table is not None:
+            # Test IT, then go straight to the MEBBE arm for the value of
+            # the variable compared. Every arm but the last ends by jumping
+            # past the others.
+            var, cases, default = node.table
+            test = len(code)
+            code.append((opTestIT, None))
+            asmBlock(node.body, unit, layout)
+            ends = [len(code)]
+            code.append((opJump, None))
+            patch(unit, test)
+            switch = len(code)
+            code.append((opSwitch, None))
+            starts = []
+            for index, (cond, arm) in enumerate(node.arms):
+                starts.append(len(code))
+                asmBlock(arm, unit, layout)
+                if index < len(node.arms) - 1:
+                    ends.append(len(code))
+                    code.append((opJump, None))
+            for end in ends:
+                patch(unit, end)
+            code[switch] = (opSwitch, (var, {
+                value: starts[index] for value, index in cases.items() },
+                len(code) if default is None else starts[default]))
+        elif kind is IfBlock:
+            # Test IT, then the condition of each MEBBE arm in turn. Every
+            # arm but the last ends by jumping past the others.
+            ends = []
+            test = len(code)
+            code.append((opTestIT, None))
+            asmBlock(node.body, unit, layout)
+            for cond, arm in node.arms:
+                ends.append(len(code))
+                code.append((opJump, None))
+                patch(unit, test)
+                test = None
+                if cond is None:    # NO WAI
+                    asmBlock(arm, unit, layout)
+                    break
+                test = asmTest(cond, unit, True)
+                asmBlock(arm, unit, layout)
+            if test is not None:
+                patch(unit, test)
+            for end in ends:
+                patch(unit, end)
+        elif kind is FuncDecl:
+            code.append((opFuncDecl, (node, assemble(node.body, node.layout,
+                                                     True))))
+        elif kind is Print:
+            if not any(hasCall(arg) for arg in node.args):
+                code.append((opVisible, node.args))
+                continue
+            for arg in node.args:
+                asmExp(arg, unit)
+            code.append((opPrint, len(node.args)))
+        elif kind is Input:
+            if node.var.__class__ is Local:
+                code.append((opInput, node.var.index))
+            else:
+                code.append((opGimmeh, node.var.name))
+        elif kind is Assign:
+            asmStore(node.var, node.value, unit)
+        elif kind is Declare:
+            # Checked before the value is evaluated, as the tree walker does
+            var = node.var
+            if var.__class__ is Var:    # Declared in the current frame
+                var = Local(var.name, layout[var.name])
+                code.append((opDeclare, var.index))
+            elif var.__class__ is Global:
+                code.append((opDeclareGlobal, var.index))
+            asmStore(var, Literal(None) if node.value is None else node.value,
+                     unit)
+        elif kind is Found:
+            if hasCall(node.value):
+                asmExp(node.value, unit)
+                if node.value.__class__ is Call:
+                    code[-1] = (opTailCall, code[-1][1])
+                code.append((opReturn, None))
+            else:
+                code.append((opReturnValue, node.value))
+        elif kind is ExpStatement:
+            asmStore(Local('IT', 0), node.value, unit)
+        elif kind is Error:
+            code.append((opError, node.message))
+
+def assemble(body, layout=globalLayout, inFunction=False):
+    """
+    Assemble a resolved program, or the body of a function, into a Unit of
+    instructions for the virtual machine.
+    """
+    unit = Unit([], [])
+    if inFunction and limited:
+        unit.code.append((opTick, None))
+    asmBlock(body, unit, layout)
+    if inFunction:  # Give NOOB if no FOUND YR is reached
+        unit.code.append((opReturnValue, Literal(None)))
+    else:
+        unit.code.append((opHalt, None))
+    return unit
+
+def inCast(unit, pc, frames):
+    "Whether the instruction before pc, or any call in progress, is in a cast."
+    for unit, pc in [(unit, pc)] + [frame[:2] for frame in frames]:
+        for start, end in unit.casts:
+            if start < pc <= end:
+                return True
+    return False
+
+def runMachine(unit, env=global_env):
+    """
+    Run an assembled program in the given global environment. Calls push a
+    frame onto a stack of their own rather than recursing in Python, so
+    LOLCODE functions may recurse as deeply as memory allows.
+    """
+    functions = {}  # The (FuncDecl, Unit) of each function declared
+    g = slots = env.slots
+    code = unit.code
+    pc = 0
+    stack = []      # Operands
+    push, pop = stack.append, stack.pop
+    frames = []     # (unit, pc, env, memo, key) of each call in progress
 
-def string(env=global_env):
     try:
-        if '"' not in code[0][0]:
-            raise IndexError
-        
-        out = code[0].popleft()
-        # Test to see if we have a long string
-        if out.count('"') < 2:
-            while '"' not in code[0][0]:
-                out += ' ' + code[0].popleft()
-            out += ' '+ code[0].popleft()
+        while True:
+            op, arg = code[pc]
+            pc += 1
+            if op == opSet:
+                index, value = arg
+                slots[index] = exp[value.__class__](value, env)
+            elif op == opTest:
+                cond, target = arg
+                if not exp[cond.__class__](cond, env):
+                    pc = target
+            elif op == opJump:
+                pc = arg
+            elif op == opTestIT:
+                if not slots[0]:
+                    pc = arg
+            elif op == opCount:
+                index, main, step, bound, body, end = arg
+                counter = g if main else slots
+                count = counter[index]
+                limit = exp[bound.__class__](bound, env)
+                if count.__class__ is int and limit.__class__ is int:
+                    count += step
+                    counter[index] = count
+                    pc = body if count != limit else end
+            elif op == opTick:
+                tick()
+            elif op == opSetGlobal:
+                index, value = arg
+                g[index] = exp[value.__class__](value, env)
+            elif op == opEval:
+                push(exp[arg.__class__](arg, env))
+            elif op == opVisible:
+                visible([exp[value.__class__](value, env) for value in arg])
+            elif op == opTestTrue:
+                cond, target = arg
+                if not exp[cond.__class__](cond, env) == True:
+                    pc = target
+            elif op == opSwitch:
+                var, targets, default = arg
+                pc = targets.get(exp[var.__class__](var, env), default)
+            elif op == opReturnValue or op == opReturn:
+                value = pop() if op == opReturn else exp[arg.__class__](arg,
+                                                                        env)
+                if not frames:  # FOUND YR in the main program
+                    raise FoundException(value)
+                unit, pc, env, memo, key = frames.pop()
+                code, slots = unit.code, env.slots
+                if memo is not None:
+                    memo.put(key, value)
+                push(value)
+            elif op == opFunc:
+                if arg not in functions:    # Not declared yet
+                    print("Error: invalid YARN.", file=programOutput)
+                    sys.exit(1)
+                push(functions[arg])
+            elif op == opCall or op == opTailCall:
+                base = len(stack) - arg
+                args = stack[base:]
+                function, callee = stack[base - 1]
+                del stack[base - 1:]
+                if arg != len(function.params):
+                    print("Error: invalid number of arguments in function "
+                          "call.", file=programOutput)
+                    sys.exit(1)
+
+                # A pure function gives the same result for the same args.
+                # Only the first of a chain of FOUND YR calls remembers it.
+                memo = key = None
+                tail = op == opTailCall and frames
+                if function.pure and memoSize and not tail:
+                    memo = memos[function.name]
+                    key = memoKey(args)
+                    result = memo.get(key)
+                    if result is not missing:
+                        push(result)
+                        continue
+
+                if not tail:
+                    frames.append((unit, pc, env, memo, key))
+                    outer = env
+                elif unseen(env):
+                    # FOUND YR a call: the caller gets its result straight
+                    # from it, and nothing looks up this frame's variables
+                    outer = env.outer
+                else:
+                    outer = env
+                env = Env(function.layout,
+                          [None] + args + [unset] * function.nlocals, outer)
+                slots = env.slots
+                unit, code, pc = callee, callee.code, 0
+            elif op == opStore:
+                slots[arg] = pop()
+            elif op == opStoreGlobal:
+                g[arg] = pop()
+            elif op == opAssign:
+                assign(env, arg, pop())
+            elif op == opJumpIfFalse:
+                if not pop():
+                    pc = arg
+            elif op == opJumpUnlessTrue:
+                if not pop() == True:
+                    pc = arg
+            elif op == opBinOp:
+                y = pop()
+                stack[-1] = arg(stack[-1], y)
+            elif op == opNot:
+                stack[-1] = not stack[-1]
+            elif op == opDecide:
+                decides, target = arg
+                if bool(pop()) is decides:
+                    push(decides)
+                    pc = target
+            elif op == opAllOf or op == opAnyOf:
+                base = len(stack) - arg
+                value = (all if op == opAllOf else any)(stack[base:])
+                del stack[base:]
+                push(value)
+            elif op == opCast:
+                stack[-1] = castValue(arg, stack[-1])
+            elif op == opPrint:
+                base = len(stack) - arg
+                visible(stack[base:])
+                del stack[base:]
+            elif op == opInput:
+                slots[arg] = readValue()
+            elif op == opGimmeh:
+                gimmeh(env, arg)
+            elif op == opDeclare:
+                declare(slots, arg)
+            elif op == opDeclareGlobal:
+                declare(g, arg)
+            elif op == opFuncDecl:
+                # Running the same declaration again keeps its memo
+                function = arg[0]
+                if functions.get(function.name) is not arg:
+                    functions[function.name] = arg
+                    if function.pure and memoSize:
+                        memos[function.name] = Memo(function.name, memoSize)
+                    declareLookups(function)
+            elif op == opError:
+                error(Error(arg))
+            elif op == opHalt:
+                return
+    except (AttributeError, KeyError, IndexError, TypeError):
+        # Errors evaluating the operand of MAEK are an invalid cast
+        if inCast(unit, pc, frames):
+            print("Error: invalid cast.", file=programOutput)
+            sys.exit(1)
+        raise
 
-        return out.strip('"')
-    except IndexError:
-        print("Error: invalid YARN.")
-        sys.exit(1)
+#--------------------------------------------------------------------------
+# Program Cache
+#--------------------------------------------------------------------------
 
-def atom(env=global_env):
-    #print("atom")
+# Where resolved programs are kept between runs, and how many bytes of
+# entries to keep before the least recently used ones are removed
+cacheDir = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                        os.path.expanduser('~/.cache'), 'lolcode')
+cacheSize = 16 * 1024 * 1024
+
+# Every kind of parse tree node, by name
+nodeTypes = { kind.__name__:kind for kind in (Loop, IfBlock, FuncDecl, Print,
+              Input, Assign, Declare, Found, ExpStatement, Error, Literal,
+              Var, Local, Global, Call, BinOp, Not, AllOf, AnyOf, Cast) }
+
+def encodeTree(node):
+    "Turn a parse tree into the lists, tuples and values marshal can store."
+    if isinstance(node, tuple):
+        items = [encodeTree(item) for item in node]
+        if hasattr(node, '_fields'):
+            return [node.__class__.__name__] + items
+        return tuple(items)
+    elif node.__class__ is Site:    # Made afresh when the tree is rebuilt
+        return None
+    return node
+
+def decodeTree(data):
+    "Rebuild the parse tree stored by encodeTree."
+    if data.__class__ is list:
+        node = nodeTypes[data[0]](*[decodeTree(item) for item in data[1:]])
+        if node.__class__ is BinOp:
+            return node._replace(site=newSite(node.op))
+        return node
+    elif data.__class__ is tuple:
+        return tuple(decodeTree(item) for item in data)
+    return data
+
+def cacheKey(path):
+    """
+    Identify a version of a program file run by this version of the
+    interpreter. An entry is only used while its key is unchanged.
+    """
+    source, interpreter = os.stat(path), os.stat(__file__)
+    return (source.st_mtime_ns, source.st_size, interpreter.st_mtime_ns,
+            interpreter.st_size, sys.version)
+
+def cacheEntry(path, compiled, cachedir):
+    "The file caching a program, with or without its compiled code."
+    name = '%s%s%s%s:%s' % ('compile' if compiled else 'tree',
+                            '-O' if optimizing else '',
+                            '-L' if compiled and limited else '',
+                            '-S' if strict else '', os.path.abspath(path))
+    return os.path.join(cachedir,
+                        hashlib.sha1(name.encode()).hexdigest() + '.lolc')
+
+def readCache(entry, key):
+    "Return the layout, body and code object cached under key, or None."
+    try:
+        with open(entry, 'rb') as file:
+            entryKey, layout, data, codeobj = marshal.load(file)
+        if entryKey != key:
+            return None
+        os.utime(entry)     # Most recently used
+        return layout, decodeTree(data), codeobj
+    except (OSError, EOFError, ValueError, TypeError, KeyError, IndexError):
+        return None     # Missing or unreadable, so parse the file again
+
+def writeCache(entry, key, layout, body, codeobj, limit=cacheSize):
+    "Cache a resolved program, then trim the cache down to limit bytes."
+    cachedir = os.path.dirname(entry)
+    temp = '%s.%d.tmp' % (entry, os.getpid())
     try:
-        out = values[code[0][0]]
-        code[0].popleft()
-    except KeyError:
+        os.makedirs(cachedir, exist_ok=True)
+        with open(temp, 'wb') as file:
+            marshal.dump((key, layout, encodeTree(body), codeobj), file)
+        os.replace(temp, entry)     # Readers never see a partial entry
+    except (OSError, ValueError):   # The program still runs uncached
         try:
-            out = int(code[0][0])
-            code[0].popleft()
-        except ValueError:
-            try:
-                out = float(code[0][0])
-                code[0].popleft()
-            except ValueError:
-                # We have a string
-                out = string()
-    return out
-
-def bothBranch(env=global_env):
+            os.remove(temp)
+        except OSError:
+            pass
+        return
+    pruneCache(cachedir, limit)
+
+def pruneCache(cachedir, limit=cacheSize):
+    "Remove the least recently used entries until the cache fits in limit."
+    entries = []
     try:
-        if code[0][1] == 'OF':
-            return both(env)
-        else:
-            return equals(env)
-    except IndexError:
-        print("Error: invalid BOTH expression.")
-        sys.exit(1)
+        for entry in os.scandir(cachedir):
+            if entry.name.endswith('.lolc'):
+                info = entry.stat()
+                entries.append((info.st_mtime, info.st_size, entry.path))
+    except OSError:
+        return
+    total = sum(size for used, size, entry in entries)
+    for used, size, entry in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.remove(entry)
+        except OSError:     # Removed by another run
+            pass
+        total -= size
 
 #--------------------------------------------------------------------------
-# Main Expression Evaluation Function
+# Memoization
 #--------------------------------------------------------------------------
 
-# Create expression dispatch dictionary
-exp = { 'BOTH':bothBranch, 'DIFFRINT':notEquals, 'BIGGR':greater, 'SMALLR':less,
-        'SUM':add, 'DIFF':sub, 'PRODUKT':mul, 'QUOSHUNT':div, 'MOD':mod,
-        'MAEK':cast, 'EITHER':either, 'ALL':allOf, 'ANY':anyOf, 'NOT':neg }
+# What a Memo gives for args it has no result for
+missing = object()
+
+class Memo(object):
+    """
+    The results of a pure function, by args, dropping the least recently
+    used once it holds size of them.
+    """
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.results = {}   # In order of use, most recent last
+        self.hits = self.misses = self.evicted = 0
+        memoTables.append(self)
+    def get(self, key):
+        "The result for key, or missing if there is none."
+        results = self.results
+        try:
+            result = results.pop(key)
+        except KeyError:
+            self.misses += 1
+            return missing
+        results[key] = result   # Now the most recently used
+        self.hits += 1
+        return result
+    def put(self, key, result):
+        results = self.results
+        if len(results) >= self.size:
+            del results[next(iter(results))]
+            self.evicted += 1
+        results[key] = result
+
+# Every Memo made, for the statistics
+memoTables = []
+
+def memoKey(args):
+    """
+    The key of a Memo for args. Python finds WIN, 1 and 1.0 (and 0.0 and
+    -0.0) equal, which LOLCODE can tell apart, so the types and the text of
+    NUMBARs are part of it.
+    """
+    return tuple([(arg.__class__, repr(arg) if arg.__class__ is float else arg)
+                  for arg in args])
+
+def memoized(function, name):
+    "Wrap a generated pure function so it remembers its results."
+    if not memoSize:
+        return function
+    memo = Memo(name, memoSize)
+    def call(env, *args):
+        key = memoKey(args)
+        result = memo.get(key)
+        if result is missing:
+            result = function(env, *args)
+            memo.put(key, result)
+        return result
+    call.nparams = function.nparams
+    return call
+
+def reportMemos(file):
+    "Write how often each memo had the result of a call, and how big it got."
+    file.write('%-24s %10s %10s %10s %8s %8s %8s\n' %
+               ('function', 'calls', 'hits', 'misses', 'hit %', 'results',
+                'evicted'))
+    for memo in memoTables:
+        calls = memo.hits + memo.misses
+        file.write('%-24s %10d %10d %10d %8.1f %8d %8d\n' %
+                   (memo.name, calls, memo.hits, memo.misses,
+                    memo.hits * 100 / calls if calls else 0,
+                    len(memo.results), memo.evicted))
 
-def expression(env=global_env):
-    #print("expression")
-    out = None
+#--------------------------------------------------------------------------
+# Profiling
+#--------------------------------------------------------------------------
+
+class Profiler(object):
+    """
+    Times statements and function calls. For each statement (by source line)
+    and each function it counts how often it ran, the time spent in it in
+    total and in itself, excluding the statements and calls it ran, and the
+    net number of memory blocks it allocated itself. The time spent in each
+    stack of statements and calls is kept for flame graphs.
+    """
+    def __init__(self, stacks=None):
+        self.stacks = stacks    # File to write the stacks to, if any
+        self.stats = {}     # {where:[count, total, self, blocks]}
+        self.paths = {}     # {(where, ...):self time}
+        self.stack = []     # [where, path, start, child time, child blocks,
+                            #  blocks] of each statement or call running
+        self.active = {}    # {where:how many times it is on the stack}
+        self.start = time.perf_counter()
+
+    def enter(self, where):
+        stack = self.stack
+        path = (stack[-1][1] if stack else ()) + (where,)
+        self.active[where] = self.active.get(where, 0) + 1
+        stack.append([where, path, time.perf_counter(), 0.0, 0,
+                      sys.getallocatedblocks()])
+
+    def leave(self):
+        where, path, start, child, childBlocks, blocks = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        blocks = sys.getallocatedblocks() - blocks
+        stats = self.stats.get(where)
+        if stats is None:
+            stats = self.stats[where] = [0, 0.0, 0.0, 0]
+        stats[0] += 1
+        self.active[where] -= 1
+        if not self.active[where]:  # Not counted again by recursive calls
+            stats[1] += elapsed
+        stats[2] += elapsed - child
+        stats[3] += blocks - childBlocks
+        self.paths[path] = self.paths.get(path, 0.0) + elapsed - child
+        if self.stack:
+            self.stack[-1][3] += elapsed
+            self.stack[-1][4] += blocks
+
+    def report(self, file):
+        "Write the statistics, the slowest functions and statements first."
+        def name(where):
+            if where[0] == 'function':
+                return 'HOW DUZ I %s' % where[1]
+            return 'line %d: %s' % (where[1], where[2])
+
+        file.write('Profile of %.3fs\n' % (time.perf_counter() - self.start))
+        sections = (('Functions', 'function'), ('Loops', 'loop'),
+                    ('Statements', 'line'))
+        for title, kind in sections:
+            rows = [(where, stats) for where, stats in self.stats.items()
+                    if where[0] == kind or kind == 'loop' and
+                    where[0] == 'line' and where[2].startswith('IM IN YR')]
+            if not rows:
+                continue
+            rows.sort(key=lambda row: row[1][1 if kind == 'loop' else 2],
+                      reverse=True)
+            file.write('\n%s\n%10s %10s %10s %12s  %s\n' %
+                       (title, 'count', 'total (s)', 'self (s)',
+                        'net blocks', 'where'))
+            for where, (count, total, own, blocks) in rows:
+                file.write('%10d %10.4f %10.4f %12d  %s\n' %
+                           (count, total, own, blocks, name(where)))
+
+    def writeStacks(self, file):
+        """
+        Write the time spent in each stack of statements and calls in the
+        collapsed stack format of flame graph tools, in microseconds.
+        """
+        for path, elapsed in sorted(self.paths.items()):
+            frames = []
+            for where in path:
+                if where[0] == 'function':
+                    frames.append('HOW DUZ I %s' % where[1])
+                else:
+                    frames.append('line %d %s' % (where[1], where[2]))
+            file.write('%s %d\n' % (';'.join(frames).replace('\n', ' '),
+                                    round(elapsed * 1e6)))
+
+def profiled(node, env=global_env):
+    "Run a statement, timing it."
+    profiler.enter(node.where)
     try:
-        out = exp[code[0][0]](env)
-    except KeyError:
-        try:
-            out = env.find(code[0][0])[code[0][0]]
-            #print("variable")
-            code[0].popleft()
-        except AttributeError:  # code[0][0] is not a variable
-            if code[0][0] in func:
-                #print('function')
-                out = funcEval(env)
-            else:
-                out = atom(env)
+        return statement[node.node.__class__](node.node, env)
+    finally:
+        profiler.leave()
 
-    # If there's nothing left, pop off empty command list
-    if len(code[0]) == 0:
-        code.popleft()
+def profiledCall(node, env=global_env):
+    "Call a function, timing the call."
+    profiler.enter(('function', node.name))
+    try:
+        return funcEval(node, env)
+    finally:
+        profiler.leave()
+
+def startProfiler(stacks=None):
+    """
+    Profile statements as they are parsed, and function calls. The report
+    goes to standard error when the program ends, and the stacks to the
+    file named stacks, if any.
+    """
+    global profiler
+    profiler = Profiler(stacks)
+    exp[Call] = profiledCall
+
+def stopProfiler():
+    "Write out the report and the stacks of the profiler."
+    profiler.report(sys.stderr)
+    if profiler.stacks is not None:
+        with open(profiler.stacks, 'w') as file:
+            profiler.writeStacks(file)
+
+#--------------------------------------------------------------------------
+# Execution Limits
+#--------------------------------------------------------------------------
+
+# The most steps (loop iterations and function calls) a program may take,
+# the time by which it must end and the most bytes of memory it may use,
+# or None for no limit
+maxSteps = deadline = maxMemory = None
+timeLimit = None    # The seconds the deadline was set from
+
+# The limits are checked every so many steps, and the memory used at most
+# every so many seconds
+checkEvery = 1000
+memoryEvery = 0.1
+
+# Steps left until the limits are next checked, out of period, the steps
+# counted before that, and when the memory was last checked
+ticks = period = checkEvery
+stepsTaken = 0
+memoryChecked = 0.0
+
+# The status a program stopped by a limit exits with
+limitStatus = 124
+
+# The limit on the data segment before the memory was limited, restored
+# when limits stop
+dataLimit = None
+
+def memoryUsed():
+    "The memory this process uses, in bytes."
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):   # Not Linux, so use the peak
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def checkLimits():
+    "Stop the program if it is over a limit, or count down to the next check."
+    global ticks, period, stepsTaken, memoryChecked
+    stepsTaken += period - ticks
+    if maxSteps is not None and stepsTaken > maxSteps:
+        print("Error: program took more than %d steps." % maxSteps,
+              file=programOutput)
+        sys.exit(limitStatus)
+    now = time.monotonic()
+    if deadline is not None and now > deadline:
+        print("Error: program ran for more than %g seconds." % timeLimit,
+              file=programOutput)
+        sys.exit(limitStatus)
+    if maxMemory is not None and now - memoryChecked >= memoryEvery:
+        memoryChecked = now
+        if memoryUsed() > maxMemory:
+            sys.exit(outOfMemory())
+
+    # Check again just after the last step allowed
+    period = checkEvery
+    if maxSteps is not None:
+        period = max(1, min(period, maxSteps - stepsTaken + 1))
+    ticks = period
+
+def outOfMemory(err=None):
+    """
+    Report that the program went over its memory limit, or that err was
+    raised if it has none, and return the status to exit with.
+    """
+    if maxMemory is None:
+        print("Unexpected error:", err, file=programOutput)
+        return 1
+    print("Error: program used more than %d bytes of memory." % maxMemory,
+          file=programOutput)
+    return limitStatus
+
+def tick():
+    "Count a step of the program."
+    global ticks
+    ticks -= 1
+    if ticks <= 0:
+        checkLimits()
+
+def limitedLoop(node, env=global_env):
+    "Run a loop as loop does, counting each iteration as a step."
+    global ticks
+    if node.count is not None:
+        done = countLoop(node, env, True)
+        if done is not uncounted:
+            return done
+    cond, body = node.cond, node.body
+    while exp[cond.__class__](cond, env):
+        ticks -= 1
+        if ticks <= 0:
+            checkLimits()
+        for stmt in body:
+            done = statement[stmt.__class__](stmt, env)
+            if done is not None:
+                return done
+
+def limitedCall(node, env=global_env):
+    "Call a function, counting the call as a step."
+    global ticks
+    ticks -= 1
+    if ticks <= 0:
+        checkLimits()
+    return unlimitedCall(node, env)
+
+# What calls functions when their steps are not counted
+unlimitedCall = funcEval
+
+def startLimits(steps=None, seconds=None, memory=None):
+    """
+    Stop programs which take more than steps steps, run for more than
+    seconds or use more than memory bytes, with an error and limitStatus.
+    Limits which are None are not checked.
+    """
+    global limited, maxSteps, deadline, timeLimit, maxMemory, unlimitedCall
+    global ticks, period, stepsTaken, memoryChecked
+    if limited:
+        stopLimits()
+    limited = True
+    maxSteps, timeLimit, maxMemory = steps, seconds, memory
+    if memory is not None:
+        # Allocations which would go far over the limit between two checks
+        # fail straight away instead
+        setDataLimit(memory)
+    deadline = None if seconds is None else time.monotonic() + seconds
+    stepsTaken, memoryChecked = 0, 0.0
+    period = checkEvery if steps is None else max(1, min(checkEvery,
+                                                         steps + 1))
+    ticks = period
+    unlimitedCall = exp[Call]
+    statement[Loop], exp[Call] = limitedLoop, limitedCall
+
+def stopLimits():
+    "Stop limiting programs."
+    global limited, maxSteps, deadline, maxMemory
+    if limited:
+        limited = False
+        statement[Loop], exp[Call] = loop, unlimitedCall
+        if maxMemory is not None:
+            setDataLimit(None)
+        maxSteps = deadline = maxMemory = None
+
+def setDataLimit(memory):
+    "Limit the data segment of this process to memory bytes, or unlimit it."
+    global dataLimit
+    try:
+        if memory is None:
+            if dataLimit is not None:
+                resource.setrlimit(resource.RLIMIT_DATA, dataLimit)
+                dataLimit = None
+            return
+        soft, hard = resource.getrlimit(resource.RLIMIT_DATA)
+        if dataLimit is None:
+            dataLimit = soft, hard
+        if hard != resource.RLIM_INFINITY:
+            memory = min(memory, hard)
+        resource.setrlimit(resource.RLIMIT_DATA, (memory, hard))
+    except (ValueError, OSError):   # Memory is still checked as it runs
+        pass
 
-    return out
-            
 #--------------------------------------------------------------------------
 # Main Program
 #--------------------------------------------------------------------------
 
 # Create statement dispatch dictionary
-statement = {'IM':loop, 'I':declaration, 'BTW':comment, 'VISIBLE':printBlock, 
-             'O':ifBlock, 'OBTW':comment, 'FOUND':found, 'GIMMEH':inputBlock,
-             'HOW':funcDecl}            
-
-def codeBlock(env=global_env):
-    try:
-        statement[code[0][0]](env)
-    except KeyError:
-        if 'R' in code[0]:  # Maybe it's an assignment
-            assignment(env)
-        else:               # Must be an expression
-            env['IT'] = expression(env)
-             
-def program():
-    try:
-        while code[0][0] != 'HAI':
-            code.popleft()
-
-        # Now the program starts   
-        code.popleft()
-        while code[0][0] != 'KTHXBAI':
-            codeBlock(global_env)
+statement = {Loop:loop, Declare:declaration, Print:printBlock, IfBlock:ifBlock,
+             Found:found, Input:inputBlock, FuncDecl:funcDecl,
+             Assign:assignment, ExpStatement:expStatement, Error:error,
+             Profile:profiled}
+
+def codeBlock(body, env=global_env):
+    for node in body:
+        done = statement[node.__class__](node, env)
+        if done is not None:
+            return done
+
+def parseFile(path):
+    "Parse and resolve a whole program file, optimizing it if asked to."
+    with open(path, 'r') as file:
+        return parseSource(file)
+
+def parseSource(file):
+    "Parse and resolve the whole program read from file."
+    code.extend(tokenize(file))
+    body = resolveProgram(parseProgram())
+    return optimizeProgram(body) if optimizing else body
+
+def streamFile(path, keep=False):
+    """
+    Run a program file while it is parsed, each statement of the main
+    program as soon as it has been read, so a long program starts straight
+    away and only its functions are kept. Returns the parsed program if
+    keep is set, as it is not resolved yet, in which case all of it is held
+    in memory: memory use is only bounded when it is not, as with
+    --no-cache.
+    """
+    with open(path, 'r') as file:
+        scanFuncNames(tokenize(file))
+
+    body = []
+    slots = global_env.slots
+    it = None   # The value of IT, while it is known
+    with open(path, 'r') as file:
+        for node in streamProgram(TokenLines(tokenize(file))):
+            if keep:
+                body.append(node)
+            nodes = (resolveTopLevel(node),)
+            if optimizing:
+                nodes, it = optimizeStatement(nodes[0], it)
+            if len(slots) < len(globalLayout):
+                slots.extend([unset] * (len(globalLayout) - len(slots)))
+            for node in nodes:
+                statement[node.__class__](node, global_env)
+    return tuple(body) if keep else None
+
+# How many bytes of output to buffer before writing it out, and of input to
+# read at a time from a batch input file
+outputBuffer = 64 * 1024
+inputBuffer = 1024 * 1024
+
+def setOutput(size=outputBuffer, fd=None):
+    """
+    Send everything printed, error messages included, through a buffer of
+    size bytes written straight to the file descriptor fd (standard output
+    by default). A size of 0 writes every line as soon as it is printed.
+    """
+    encoding, errors = sys.stdout.encoding, sys.stdout.errors
+    sys.stdout.flush()
+    if fd is None:
+        fd = sys.stdout.fileno()
+    raw = io.FileIO(fd, 'w', closefd=False)
+    sys.stdout = io.TextIOWrapper(io.BufferedWriter(raw, max(size, 1)),
+                                  encoding, errors, line_buffering=size == 0)
+
+def execute(body, codeobj=None, machine=False):
+    "Run a resolved program, with the virtual machine or its compiled code."
+    global_env.slots.extend([unset] * (len(globalLayout) -
+                                       len(global_env.slots)))
+    if codeobj is not None:
+        runCompiled(codeobj, global_env)
+    elif machine:
+        runMachine(assemble(body), global_env)
+    else:
+        codeBlock(body, global_env)
+
+def program(path, compiled=False, cachedir=cacheDir, limit=cacheSize,
+            machine=False):
+    try:
+        cached = None
+        if cachedir is not None:
+            key = cacheKey(path)
+            entry = cacheEntry(path, compiled, cachedir)
+            cached = readCache(entry, key)
+
+        if cached is not None:
+            layout, body, codeobj = cached
+            globalLayout.clear()
+            globalLayout.update(layout)
+        elif compiled:
+            body = parseFile(path)
+            codeobj = compileProgram(body)
+            if cachedir is not None:
+                writeCache(entry, key, dict(globalLayout), body, codeobj,
+                           limit)
+        elif machine:   # Assembled from the whole program, not streamed
+            body, codeobj = parseFile(path), None
+            if cachedir is not None:
+                writeCache(entry, key, dict(globalLayout), body, None, limit)
+        else:
+            body = streamFile(path, keep=cachedir is not None)
+            if cachedir is not None:
+                layout = {'IT':0}
+                body = resolveProgram(body, layout)
+                if optimizing:
+                    body = optimizeProgram(body)
+                writeCache(entry, key, layout, body, None, limit)
+            sys.exit()
+
+        execute(body, codeobj, machine)
         sys.exit()
-    except IndexError:
-        print("Error: unexpected end of file. Expecting keyword KTHXBAI")
-        sys.exit(1)
+    except MemoryError as err:
+        sys.exit(outOfMemory(err))
     except Exception as err:
-        print("Unexpected error:", err)
+        print("Unexpected error:", err, file=programOutput)
         sys.exit(1)
+    finally:
+        sys.stdout.flush()
+        if profiler is not None:
+            stopProfiler()
+        if memoStats:
+            reportMemos(sys.stderr)
+        if siteStats:
+            reportSites(sys.stderr)
+
+#--------------------------------------------------------------------------
+# Running Programs In Process
+#--------------------------------------------------------------------------
+
+# What running a program gave: the status it would have exited with, and
+# its output if it was not written to a file
+Result = namedtuple('Result', 'status output')
+
+# Held while a program runs, as programs share the interpreter's globals.
+# The thread running a program may run another, e.g. from the file its
+# output goes to, which then runs in a state of its own.
+runLock = threading.RLock()
+
+# The module globals running a program sets, and the tables it changes
+stateNames = ('batchInput', 'programOutput', 'optimizing', 'memoSize',
+              'strict', 'limited', 'maxSteps', 'deadline', 'timeLimit',
+              'maxMemory', 'ticks', 'period', 'stepsTaken', 'memoryChecked',
+              'unlimitedCall')
+stateTables = (code, func, funcNames, varScopes, lookedUp, memos, memoTables,
+               siteTables, globalLayout, global_env.slots, statement, exp)
+
+def saveState():
+    "The state of the program running now, or of none, to restore later."
+    return ({name:globals()[name] for name in stateNames},
+            [table.copy() for table in stateTables])
+
+def restoreState(state):
+    "Go back to a state saveState returned."
+    names, tables = state
+    globals().update(names)
+    for table, saved in zip(stateTables, tables):
+        table.clear()
+        if isinstance(table, (dict, set)):
+            table.update(saved)
+        else:
+            table.extend(saved)
+    if limited and maxMemory is not None:
+        setDataLimit(maxMemory)     # Given up by the program run since
+
+def resetState():
+    "Forget everything the last program declared, so another can run."
+    code.clear()
+    func.clear()
+    funcNames.clear()
+    varScopes[:] = [set()]  # Those saved by a program running keep theirs
+    lookedUp.clear()
+    memos.clear()
+    del memoTables[:]
+    del siteTables[:]
+    globalLayout.clear()
+    globalLayout['IT'] = 0
+    global_env.slots[:] = [None]
+
+def exitStatus(exit):
+    "The status a process exiting with exit would have."
+    if exit.code is None:
+        return 0
+    return exit.code if isinstance(exit.code, int) else 1
+
+class Interpreter(object):
+    """
+    Runs programs one after another in this process, without the cost of
+    starting a new one for each. Every program starts from a fresh state,
+    and errors are returned as its status rather than exiting. A program
+    writes to and reads from the streams given to run, never sys.stdout or
+    sys.stdin, so what other threads print is not mixed into its output.
+    The parsed programs (and their Python code) of the last keep sources
+    run are kept, so running one of them again starts straight away. Each
+    program may take at most steps steps, seconds seconds and memory bytes,
+    if those are given.
+
+    The state of a program, its variables, functions and streams among it,
+    is kept in the module's globals rather than in the Interpreter, so only
+    one program runs at a time in a process, whichever Interpreter runs it:
+    run waits for one running in another thread to finish. A program may
+    run another in the same thread, e.g. from the file its output goes to,
+    and its state is put back afterwards.
+    """
+    def __init__(self, compiled=False, machine=False, optimize=False,
+                 memo=memoSize, keep=0, steps=None, seconds=None,
+                 memory=None, strict=False):
+        self.compiled = compiled    # Run the generated Python code
+        self.machine = machine      # Run on the virtual machine
+        self.optimize = optimize    # As the -O option does
+        self.strict = strict        # As the --strict option does
+        self.memo = memo            # Results each pure function keeps
+        self.keep = keep
+        self.limits = (steps, seconds, memory)
+        self.programs = {}  # (layout, body, codeobj) by source digest, in
+                            # order of use, most recent last
+    def load(self, source):
+        "Parse and compile source, or find it among the programs kept."
+        key = hashlib.sha1(source.encode('utf-8', 'surrogatepass')).digest()
+        program = self.programs.pop(key, None)
+        if program is None:
+            body = parseSource(io.StringIO(source))
+            codeobj = compileProgram(body) if self.compiled else None
+            program = dict(globalLayout), body, codeobj
+        else:
+            globalLayout.update(program[0])
+        if self.keep:
+            self.programs[key] = program
+            if len(self.programs) > self.keep:
+                del self.programs[next(iter(self.programs))]
+        return program[1:]
+    def run(self, source, stdin=None, stdout=None):
+        """
+        Run the program source. GIMMEH reads from stdin, a file or a
+        string, without prompting. The output goes to the file stdout, or is
+        returned in the Result as a string if there is none.
+        """
+        global batchInput, programOutput, optimizing, memoSize, strict
+        output = io.StringIO() if stdout is None else stdout
+        if stdin is None or isinstance(stdin, str):
+            stdin = io.StringIO(stdin or '')
+
+        with runLock:
+            # A timer's signal, such as a batch job's, waits while the state
+            # is switched, so the exception it raises cannot leave it half
+            # switched
+            mask = signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM])
+            saved = saveState()
+            stopLimits()
+            resetState()
+            batchInput, programOutput = stdin, output
+            optimizing, memoSize = self.optimize, self.memo
+            strict = self.strict
+            try:
+                signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+                if self.limits != (None, None, None):
+                    startLimits(*self.limits)
+                body, codeobj = self.load(source)
+                execute(body, codeobj, self.machine)
+                status = 0
+            except SystemExit as exit:
+                status = exitStatus(exit)
+            except MemoryError as err:
+                status = outOfMemory(err)
+            except Exception as err:
+                print("Unexpected error:", err, file=programOutput)
+                status = 1
+            finally:
+                signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGALRM])
+                try:
+                    output.flush()
+                    stopLimits()
+                    restoreState(saved) # Nothing is kept for the next program
+                finally:
+                    signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+        return Result(status, output.getvalue() if stdout is None else None)
+
+#--------------------------------------------------------------------------
+# Batch Runner
+#--------------------------------------------------------------------------
+
+# How long a program in a batch may run, in seconds, before it is stopped
+jobTimeout = 60.0
+
+# The switches a .options file next to a program of a batch may give it, on
+# top of those given to the batch, and the Interpreter option each sets
+fileOptions = { '--compile':'compiled', '--vm':'machine', '-O':'optimize',
+                '--strict':'strict' }
+
+class JobTimeout(BaseException):
+    "Raised in a batch job which ran out of time. Programs cannot catch it."
+
+def findPrograms(path):
+    "The program files in a directory and its subdirectories, in order."
+    if not os.path.isdir(path):
+        return [path]
+    found = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        found.extend(os.path.join(root, name) for name in sorted(files)
+                     if name.endswith('.lol'))
+    return found
+
+def readSibling(path, extension):
+    "The text of the file next to a program with another extension, or None."
+    try:
+        with open(os.path.splitext(path)[0] + extension, 'r',
+                  newline='') as file:
+            return file.read()
+    except OSError:
+        return None
+
+def programOptions(path, options):
+    "The options of a batch with those in the program's .options file added."
+    options = dict(options)
+    for word in (readSibling(path, '.options') or '').split():
+        if word not in fileOptions:
+            raise ValueError('unknown option %s in .options file' % word)
+        options[fileOptions[word]] = True
+    return options
+
+def timeUp(signum, frame):
+    raise JobTimeout()
+
+def runJob(path, options, timeout=jobTimeout):
+    """
+    Run a program of a batch, with the input in the .in file next to it if
+    there is one and the options in the .options file next to it. Returns
+    (status, output, seconds), with a status of None if it took longer than
+    timeout seconds.
+    """
+    start = time.perf_counter()
+    signal.signal(signal.SIGALRM, timeUp)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        with open(path, 'r') as file:
+            source = file.read()
+        status, output = Interpreter(**programOptions(path, options)).run(
+            source, readSibling(path, '.in'))
+    except JobTimeout:
+        status, output = None, ''
+    except OSError as err:
+        status, output = 1, 'cannot read program: %s\n' % err
+    except ValueError as err:
+        status, output = 1, '%s\n' % err
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    return status, output, time.perf_counter() - start
+
+def runBatch(path, jobs=None, options={}, timeout=jobTimeout, diff=True):
+    """
+    Run every program under path across jobs processes, comparing their
+    output with the .out file next to each one unless diff is false, and
+    report how each did. Returns the status to exit with: 1 if any program
+    failed.
+    """
+    paths = findPrograms(path)
+    start = time.perf_counter()
+    sys.stdout.flush()  # Workers start with a copy of the output buffer
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(runJob, program, options, timeout)
+                   for program in paths]
+        results = [future.result() for future in futures]
+    wall = time.perf_counter() - start
+
+    failed, counts = [], {}
+    for program, (status, output, seconds) in zip(paths, results):
+        expected = readSibling(program, '.out') if diff else None
+        if status is None:
+            outcome = 'TIMEOUT'
+        elif expected is not None:
+            outcome = 'ok' if output == expected else 'FAIL'
+        else:
+            outcome = 'ok' if status == 0 else 'EXIT %d' % status
+        counts[outcome.split()[0]] = counts.get(outcome.split()[0], 0) + 1
+        print('%-8s %8.3fs  %s' % (outcome, seconds, program))
+        if outcome == 'FAIL':
+            failed.append((program, expected, output))
+
+    for program, expected, output in failed:
+        sys.stdout.writelines(difflib.unified_diff(
+            expected.splitlines(True), output.splitlines(True),
+            program[:-4] + '.out', program))
+
+    busy = sum(seconds for status, output, seconds in results)
+    print('%d programs: %s' % (len(paths), ', '.join(
+        '%d %s' % (counts[outcome], outcome) for outcome in sorted(counts))))
+    print('%.3fs of programs in %.3fs with -j %d' %
+          (busy, wall, jobs or os.cpu_count()))
+    return 0 if counts.get('ok', 0) == len(paths) else 1
+
+#--------------------------------------------------------------------------
+# Server
+#--------------------------------------------------------------------------
+
+# A client connects to the server's Unix domain socket and sends a request,
+# a line of JSON: {"source": program text, "stdin": input for GIMMEH}. The
+# server sends back the output of the program as it is written, in frames
+# of b'O<length>\n' followed by that many bytes of UTF-8, then b'X<status>\n'
+# with the status the program would have exited with: 124 if it ran out of
+# time, 2 if the request was not understood.
+
+# How many programs the server keeps parsed, how many bytes of output it
+# sends at a time, and the most bytes a request may take up
+serveKeep = 256
+serveBuffer = 16 * 1024
+serveRequestMax = 16 * 1024 * 1024
+
+class FrameWriter(io.RawIOBase):
+    "Send what is written to a socket as output frames."
+    def __init__(self, connection):
+        self.connection = connection
+        self.broken = False     # The client went away, so output is dropped
+    def writable(self):
+        return True
+    def write(self, data):
+        if not self.broken:
+            try:
+                self.connection.sendall(b'O%d\n' % len(data) + bytes(data))
+            except OSError:
+                self.broken = True
+        return len(data)
+
+def handleRequest(connection, interpreter, timeout=jobTimeout):
+    "Run the program a client sent and send back its output and status."
+    output = io.TextIOWrapper(io.BufferedWriter(FrameWriter(connection),
+                                                serveBuffer), 'utf-8')
+    # A client which sends nothing, or sends too much, cannot hold up the
+    # server for longer than a program may run
+    connection.settimeout(timeout)
+    try:
+        line = connection.makefile('rb').readline(serveRequestMax + 1)
+        if len(line) > serveRequestMax:
+            raise ValueError('longer than %d bytes' % serveRequestMax)
+        request = json.loads(line)
+        source, stdin = request['source'], request.get('stdin')
+        if not isinstance(source, str) or not isinstance(stdin, (str,
+                                                                 type(None))):
+            raise TypeError('source and stdin must be strings')
+    except (OSError, ValueError, KeyError, TypeError) as err:
+        output.write("Error: invalid request: %s\n" % err)
+        status = 2
+    else:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            status = interpreter.run(source, stdin, output).status
+        except JobTimeout:
+            output.write("Error: timed out after %g seconds.\n" % timeout)
+            status = 124
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    try:
+        output.flush()
+        connection.sendall(b'X%d\n' % status)
+    except OSError:     # The client went away
+        pass
+
+def serve(path, options={}, timeout=jobTimeout):
+    """
+    Run the programs sent to the Unix domain socket at path, one at a time,
+    each with a fresh state, until interrupted.
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)     # Left behind by an earlier server
+    except FileNotFoundError:
+        pass
+    interpreter = Interpreter(keep=serveKeep, **options)
+    signal.signal(signal.SIGALRM, timeUp)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(path)
+        server.listen()
+        while True:
+            connection, address = server.accept()
+            with connection:
+                handleRequest(connection, interpreter, timeout)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def request(path, source, stdin=None, stdout=None):
+    """
+    Have the server at path run a program, writing its output to the binary
+    file stdout (standard output by default) as it arrives. Returns the
+    status of the program.
+    """
+    stdout = stdout or sys.stdout.buffer
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        connection.sendall(json.dumps({ 'source':source,
+                                        'stdin':stdin }).encode() + b'\n')
+        reply = connection.makefile('rb')
+        while True:
+            header = reply.readline()
+            if header[:1] == b'O':
+                stdout.write(reply.read(int(header[1:])))
+            elif header[:1] == b'X':
+                stdout.flush()
+                return int(header[1:])
+            else:
+                raise EOFError('the server closed the connection')
 
 if __name__ == "__main__":
     try:
-        optlist, args = getopt.getopt(sys.argv[1:], 'f:')
-    except getopt.GetoptError:
+        optlist, args = getopt.getopt(sys.argv[1:], 'f:Oj:',
+                                      ['compile', 'no-cache', 'cache-dir=',
+                                       'cache-size=', 'output-buffer=',
+                                       'output-fd=', 'input=', 'profile',
+                                       'profile-stacks=', 'no-memo',
+                                       'memo-size=', 'memo-stats', 'vm',
+                                       'batch=', 'job-timeout=', 'no-diff',
+                                       'serve=', 'connect=', 'max-steps=',
+                                       'timeout=', 'max-memory=', 'strict',
+                                       'no-quicken', 'site-stats'])
+    except getopt.GetoptError as err:
         print(err)
         sys.exit(1)
 
-    file = None
+    path, compiled, cached, machine = None, False, True, False
+    cachedir, limit = cacheDir, cacheSize
+    buffered, size, fd = not sys.stdout.isatty(), outputBuffer, None
+    profiling, stacks = False, None
+    batch, jobs, timeout, diff = None, None, jobTimeout, True
+    server, connect = None, None
+    steps, seconds, memory = None, None, None
     for option, value in optlist:
         if option == '-f':
-            file = open(value, 'r')
+            path = value
+        elif option == '--compile':
+            compiled = True
+        elif option == '--vm':
+            machine = True
+        elif option == '-O':
+            optimizing = True
+        elif option == '--strict':
+            strict = True
+        elif option == '--no-cache':
+            cached = False
+        elif option == '--cache-dir':
+            cachedir = value
+        elif option == '--cache-size':
+            try:
+                limit = int(value)
+            except ValueError:
+                print("option --cache-size requires a number of bytes")
+                sys.exit(1)
+        elif option == '--output-buffer':
+            try:
+                buffered, size = True, int(value)
+            except ValueError:
+                print("option --output-buffer requires a number of bytes")
+                sys.exit(1)
+        elif option == '--input':
+            try:
+                if value == '-':    # Standard input, read in larger chunks
+                    value = sys.stdin.fileno()
+                setInput(open(value, 'r', inputBuffer, sys.stdin.encoding,
+                              sys.stdin.errors, closefd=value != 0))
+            except OSError as err:
+                print("cannot read input:", err)
+                sys.exit(1)
+        elif option == '--profile':
+            profiling = True
+        elif option == '--profile-stacks':
+            profiling, stacks = True, value
+        elif option == '--no-memo':
+            memoSize = 0
+        elif option == '--memo-size':
+            try:
+                memoSize = int(value)
+            except ValueError:
+                print("option --memo-size requires a number of results")
+                sys.exit(1)
+        elif option == '--memo-stats':
+            memoStats = True
+        elif option == '--no-quicken':
+            quickening = False
+        elif option == '--site-stats':
+            siteStats = True
+        elif option == '--batch':
+            batch = value
+        elif option == '-j':
+            try:
+                jobs = int(value)
+            except ValueError:
+                print("option -j requires a number of processes")
+                sys.exit(1)
+        elif option == '--job-timeout':
+            try:
+                timeout = float(value)
+            except ValueError:
+                print("option --job-timeout requires a number of seconds")
+                sys.exit(1)
+        elif option == '--no-diff':
+            diff = False
+        elif option == '--max-steps':
+            try:
+                steps = int(value)
+            except ValueError:
+                print("option --max-steps requires a number of steps")
+                sys.exit(1)
+        elif option == '--timeout':
+            try:
+                seconds = float(value)
+            except ValueError:
+                print("option --timeout requires a number of seconds")
+                sys.exit(1)
+        elif option == '--max-memory':
+            try:
+                memory = int(value)
+            except ValueError:
+                print("option --max-memory requires a number of bytes")
+                sys.exit(1)
+        elif option == '--serve':
+            server = value
+        elif option == '--connect':
+            connect = value
+        elif option == '--output-fd':
+            try:
+                buffered, fd = True, int(value)
+            except ValueError:
+                print("option --output-fd requires a file descriptor")
+                sys.exit(1)
 
-    for line in file:
-        if len(line) > 1: #There is more than just a newline character          
-            softbreaks = line.split(',')
-            for token in softbreaks:
-                code.append(deque(token.split()))
+    # Terminals see each line as it is printed unless asked otherwise
+    if buffered:
+        try:
+            setOutput(size, fd)
+        except OSError as err:
+            print("cannot write output:", err)
+            sys.exit(1)
+
+    options = { 'compiled':compiled, 'machine':machine,
+                'optimize':optimizing, 'memo':memoSize, 'steps':steps,
+                'seconds':seconds, 'memory':memory, 'strict':strict }
+    if batch is not None:
+        try:
+            sys.exit(runBatch(batch, jobs, options, timeout, diff))
+        finally:
+            sys.stdout.flush()
+    elif server is not None:
+        serve(server, options, timeout)
+        sys.exit()
+    elif connect is not None:
+        if path is None:
+            print("option --connect requires a program given with -f")
+            sys.exit(1)
+        try:
+            with open(path, 'r') as file:
+                source = file.read()
+            sys.stdout.flush()
+            sys.exit(request(connect, source, batchInput and
+                             batchInput.read()))
+        except (OSError, EOFError) as err:
+            print("cannot run program on server:", err)
+            sys.exit(1)
+
+    # Only the parse tree of this run is profiled, so it is not cached
+    if profiling:
+        startProfiler(stacks)
+        compiled, cached, machine = False, False, False
+
+    if (steps, seconds, memory) != (None, None, None):
+        startLimits(steps, seconds, memory)
 
-    program()
+    program(path, compiled, cachedir if cached else None, limit, machine)
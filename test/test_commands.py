@@ -0,0 +1,270 @@
+"""
+test_commands.py
+Tests of the ways lolcode.py runs programs besides running one file.
+
+Programs stopped by --max-steps, --timeout or --max-memory exit with status
+124 in every engine, as they do through an Interpreter. Programs sent to a
+server with --connect print and exit as they would if run themselves, each
+in a fresh state, or with status 124 if they run out of time. A batch
+reports each of its programs as ok, FAIL, EXIT or TIMEOUT, and exits with
+status 1 unless all of them passed. Cached programs are used until their
+file changes, and the least recently used are removed once the cache is
+larger than --cache-size.
+
+Usage: python3 -m unittest discover test
+"""
+
+import sys, os, re, subprocess, tempfile, unittest, signal, socket, time
+
+here = os.path.dirname(os.path.abspath(__file__))
+interpreter = os.path.join(os.path.dirname(here), 'lolcode.py')
+sys.path.insert(0, os.path.dirname(here))
+import lolcode
+
+engines = ([], ['--vm'], ['--compile'])
+
+# Counts for ever
+forever = ('HAI\nI HAS A i ITZ 0\nIM IN YR loop WILE WIN\n'
+           'i R SUM OF i AN 1\nIM OUTTA YR loop\nKTHXBAI\n')
+# Doubles a YARN for ever
+growing = ('HAI\nI HAS A s ITZ "abcdefgh"\nIM IN YR loop WILE WIN\n'
+           's R SUM OF s AN s\nIM OUTTA YR loop\nKTHXBAI\n')
+
+def lolcodeRun(args, stdin=None, timeout=60):
+    "Run lolcode.py with args, returning (status, output)."
+    process = subprocess.run([sys.executable, interpreter] + list(args),
+                             input=stdin, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, timeout=timeout)
+    return process.returncode, process.stdout.decode('utf-8')
+
+def writeFile(directory, name, text):
+    "Write a file in directory, returning its path."
+    path = os.path.join(directory, name)
+    with open(path, 'w') as file:
+        file.write(text)
+    return path
+
+class LimitsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def runLimited(self, source, option):
+        path = writeFile(self.directory.name, 'limited.lol', source)
+        for engine in engines:
+            with self.subTest(option=option, engine=engine):
+                yield lolcodeRun(['--no-cache'] + engine + [option, '-f',
+                                                            path])
+
+    def test_max_steps(self):
+        for result in self.runLimited(forever, '--max-steps=1000'):
+            self.assertEqual(result, (124, 'Error: program took more than '
+                                           '1000 steps.\n'))
+
+    def test_timeout(self):
+        for result in self.runLimited(forever, '--timeout=0.5'):
+            self.assertEqual(result, (124, 'Error: program ran for more '
+                                           'than 0.5 seconds.\n'))
+
+    def test_max_memory(self):
+        for result in self.runLimited(growing, '--max-memory=300000000'):
+            self.assertEqual(result, (124, 'Error: program used more than '
+                                           '300000000 bytes of memory.\n'))
+
+    def test_within_limits(self):
+        source = 'HAI\nVISIBLE "fine" MKAY?\nKTHXBAI\n'
+        for result in self.runLimited(source, '--max-steps=1000'):
+            self.assertEqual(result, (0, 'fine \n'))
+
+    def test_interpreter_limits(self):
+        result = lolcode.Interpreter(steps=1000).run(forever)
+        self.assertEqual(result, (124, 'Error: program took more than '
+                                       '1000 steps.\n'))
+        # The next program is not limited
+        self.assertEqual(lolcode.Interpreter().run(
+            'HAI\nVISIBLE 1 MKAY?\nKTHXBAI\n'), (0, '1 \n'))
+
+class ServerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.socket = os.path.join(cls.directory.name, 'server')
+        cls.server = subprocess.Popen([sys.executable, interpreter,
+                                       '--serve', cls.socket,
+                                       '--job-timeout=2'])
+        deadline = time.monotonic() + 30
+        while not os.path.exists(cls.socket):
+            if time.monotonic() > deadline or cls.server.poll() is not None:
+                cls.tearDownClass()
+                raise RuntimeError('the server did not start')
+            time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.server.poll() is None:
+            cls.server.send_signal(signal.SIGINT)
+            cls.server.wait(30)
+        cls.directory.cleanup()
+
+    def connect(self, source, stdin=None, args=()):
+        path = writeFile(self.directory.name, 'sent.lol', source)
+        if stdin is not None:
+            args = ['--input', writeFile(self.directory.name, 'sent.in',
+                                         stdin)] + list(args)
+        return lolcodeRun(['--connect', self.socket, '-f', path] +
+                          list(args))
+
+    def test_program(self):
+        source = ('HAI\nI HAS A name\nGIMMEH name\n'
+                  'VISIBLE "hello" name MKAY?\nKTHXBAI\n')
+        self.assertEqual(self.connect(source, 'cat\n'), (0, 'hello cat \n'))
+
+    def test_error_status(self):
+        self.assertEqual(self.connect('HAI\nVISIBLE "oops\nKTHXBAI\n'),
+                         (1, 'Error: invalid YARN.\n'))
+
+    def test_fresh_state(self):
+        source = 'HAI\nI HAS A x ITZ 2\nVISIBLE x MKAY?\nKTHXBAI\n'
+        self.assertEqual(self.connect(source), (0, '2 \n'))
+        self.assertEqual(self.connect(source), (0, '2 \n'))
+
+    def test_timeout(self):
+        self.assertEqual(self.connect(forever),
+                         (124, 'Error: timed out after 2 seconds.\n'))
+        # The server goes on to the next program
+        self.assertEqual(self.connect('HAI\nVISIBLE 1 MKAY?\nKTHXBAI\n'),
+                         (0, '1 \n'))
+
+    def test_invalid_request(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(self.socket)
+            client.sendall(b'not a request\n')
+            reply = client.makefile('rb').read()
+        self.assertTrue(reply.startswith(b'O'))
+        self.assertIn(b'Error: invalid request', reply)
+        self.assertTrue(reply.endswith(b'X2\n'))
+
+    def test_connect_needs_program(self):
+        self.assertEqual(lolcodeRun(['--connect', self.socket]),
+                         (1, 'option --connect requires a program given '
+                             'with -f\n'))
+
+class BatchTest(unittest.TestCase):
+    # Files of a batch by name, and what --batch reports for each program
+    files = { 'pass.lol':'HAI\nVISIBLE "yes" MKAY?\nKTHXBAI\n',
+              'pass.out':'yes \n',
+              'wrong.lol':'HAI\nVISIBLE "no" MKAY?\nKTHXBAI\n',
+              'wrong.out':'yes \n',
+              'reads.lol':('HAI\nI HAS A x\nGIMMEH x\nVISIBLE x x MKAY?\n'
+                           'KTHXBAI\n'),
+              'reads.in':'twice\n',
+              'reads.out':'twice twice \n',
+              'noout.lol':'HAI\nVISIBLE "anything" MKAY?\nKTHXBAI\n',
+              'error.lol':'HAI\nVISIBLE "oops\nKTHXBAI\n',
+              'slow.lol':forever,
+              'strict.lol':('HAI\nHOW DUZ I f\nVISIBLE "called" MKAY?\n'
+                            'IF U SAY SO\nEITHER OF WIN AN f MKAY?\n'
+                            'KTHXBAI\n'),
+              'strict.options':'--strict\n',
+              'strict.out':'called \n' }
+    outcomes = { 'error.lol':'EXIT 1', 'noout.lol':'ok', 'pass.lol':'ok',
+                 'reads.lol':'ok', 'slow.lol':'TIMEOUT', 'strict.lol':'ok',
+                 'wrong.lol':'FAIL' }
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        for name, text in self.files.items():
+            writeFile(self.directory.name, name, text)
+
+    def runBatch(self, *args):
+        "Run the batch, returning its status, outcomes and other lines."
+        status, output = lolcodeRun(['--batch', self.directory.name,
+                                     '--job-timeout=1'] + list(args))
+        outcomes, rest = {}, []
+        for line in output.splitlines():
+            match = re.match(r'(\S+(?: \d+)?) +[\d.]+s  (.*)$', line)
+            if match:
+                outcomes[os.path.basename(match.group(2))] = match.group(1)
+            else:
+                rest.append(line)
+        return status, outcomes, rest
+
+    def test_batch(self):
+        for jobs in ('1', '2'):
+            with self.subTest(jobs=jobs):
+                status, outcomes, rest = self.runBatch('-j', jobs)
+                self.assertEqual(status, 1)
+                self.assertEqual(outcomes, self.outcomes)
+                self.assertIn('-yes ', rest)     # The difference
+                self.assertIn('+no ', rest)
+                self.assertIn('7 programs: 1 EXIT, 1 FAIL, 1 TIMEOUT, '
+                              '4 ok', rest)
+
+    def test_no_diff(self):
+        status, outcomes, rest = self.runBatch('--no-diff')
+        self.assertEqual(status, 1)
+        self.assertEqual(outcomes, dict(self.outcomes, **{'wrong.lol':'ok'}))
+
+    def test_passing(self):
+        for name in ('wrong.lol', 'error.lol', 'slow.lol'):
+            os.remove(os.path.join(self.directory.name, name))
+        status, outcomes, rest = self.runBatch('--vm')
+        self.assertEqual(status, 0)
+        self.assertEqual(set(outcomes.values()), {'ok'})
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache = os.path.join(self.directory.name, 'cache')
+
+    def program(self, name, word):
+        "Write a program printing word, returning its path."
+        return writeFile(self.directory.name, name + '.lol',
+                         'HAI\nVISIBLE "%s" MKAY?\nKTHXBAI\n' % word)
+
+    def entry(self, path):
+        return lolcode.cacheEntry(path, False, self.cache)
+
+    def cachedRun(self, path, *args):
+        return lolcodeRun(['--cache-dir', self.cache] + list(args) +
+                          ['-f', path])
+
+    def test_reused(self):
+        path = self.program('a', 'first')
+        self.assertEqual(self.cachedRun(path), (0, 'first \n'))
+        entry = self.entry(path)
+        self.assertTrue(os.path.exists(entry))
+        os.utime(entry, (0, 0))
+        self.assertEqual(self.cachedRun(path), (0, 'first \n'))
+        self.assertGreater(os.stat(entry).st_mtime, 0)     # Used again
+        self.assertEqual(self.cachedRun(path, '--compile'), (0, 'first \n'))
+        self.assertEqual(len(os.listdir(self.cache)), 2)
+
+    def test_invalidated(self):
+        path = self.program('a', 'first')
+        self.assertEqual(self.cachedRun(path), (0, 'first \n'))
+        mtime = os.stat(path).st_mtime_ns
+        self.program('a', 'other')     # The same size
+        os.utime(path, ns=(mtime + 10**9, mtime + 10**9))
+        self.assertEqual(self.cachedRun(path), (0, 'other \n'))
+        self.program('a', 'longer one')
+        self.assertEqual(self.cachedRun(path), (0, 'longer one \n'))
+
+    def test_pruned(self):
+        paths = [self.program(name, name * 8) for name in 'abc']
+        self.cachedRun(paths[0])
+        size = os.stat(self.entry(paths[0])).st_size
+        limit = '--cache-size=%d' % (size * 5 // 2)    # Two entries fit
+        now = time.time()
+        for path, age in ((paths[0], 100), (paths[1], 50)):
+            self.cachedRun(path, limit)
+            os.utime(self.entry(path), (now - age, now - age))
+        self.cachedRun(paths[0], limit)     # Now the most recently used
+        self.cachedRun(paths[2], limit)
+        self.assertEqual([os.path.exists(self.entry(path))
+                          for path in paths], [True, False, True])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+"""
+test_interpreter.py
+Tests of running programs in process with lolcode.Interpreter.
+
+Every program in the test directory must give the same status and output
+through an Interpreter as through lolcode.py with its input read from the
+.in file next to it (or from nothing) and the options in the .options file
+next to it, in every engine. Programs must not see what other threads
+print, and may run other programs.
+
+Usage: python3 -m unittest discover test
+"""
+
+import sys, os, io, subprocess, threading, unittest, tempfile, time
+
+here = os.path.dirname(os.path.abspath(__file__))
+interpreter = os.path.join(os.path.dirname(here), 'lolcode.py')
+sys.path.insert(0, os.path.dirname(here))
+import lolcode
+
+def cliRun(path, options=()):
+    "Run a program with lolcode.py, returning (status, output)."
+    stdin = os.path.splitext(path)[0] + '.in'
+    options = (lolcode.readSibling(path, '.options') or '').split() + \
+        list(options)
+    process = subprocess.run([sys.executable, interpreter, '--no-cache',
+                              '--input', stdin if os.path.exists(stdin)
+                              else os.devnull] + options +
+                             ['-f', path], stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, timeout=60)
+    return process.returncode, process.stdout.decode('utf-8')
+
+def inProcess(path, **options):
+    "Run a program with an Interpreter, returning (status, output)."
+    with open(path, 'r') as file:
+        source = file.read()
+    stdin = lolcode.readSibling(path, '.in')
+    options = lolcode.programOptions(path, options)
+    return tuple(lolcode.Interpreter(**options).run(source, stdin))
+
+class CorpusTest(unittest.TestCase):
+    programs = lolcode.findPrograms(here)
+
+    def test_matches_command_line(self):
+        for path in self.programs:
+            with self.subTest(program=path):
+                self.assertEqual(inProcess(path), cliRun(path))
+
+    def test_engines_agree(self):
+        for path in self.programs:
+            expected = inProcess(path)
+            for options in ({'compiled':True}, {'machine':True},
+                            {'optimize':True}):
+                with self.subTest(program=path, **options):
+                    self.assertEqual(inProcess(path, **options), expected)
+
+class IsolationTest(unittest.TestCase):
+    # Prints a line, then spins until a flag is set by another program
+    source = ('HAI\nVISIBLE "start" MKAY?\nI HAS A i ITZ 0\n'
+              'IM IN YR loop WILE DIFFRINT i AN 200000\n'
+              'i R SUM OF i AN 1\nIM OUTTA YR loop\n'
+              'VISIBLE "done" MKAY?\nKTHXBAI\n')
+
+    def test_other_threads_not_captured(self):
+        host = io.StringIO()
+        started = threading.Event()
+
+        class Output(io.StringIO):
+            def write(self, text):
+                started.set()
+                return super().write(text)
+
+        def printer():
+            started.wait()
+            print('HOST THREAD LINE', file=sys.stdout)
+
+        saved, sys.stdout = sys.stdout, host
+        try:
+            thread = threading.Thread(target=printer)
+            thread.start()
+            output = Output()
+            status = lolcode.Interpreter().run(self.source, None,
+                                               output).status
+            thread.join()
+        finally:
+            sys.stdout = saved
+        self.assertEqual(status, 0)
+        self.assertEqual(output.getvalue(), 'start \ndone \n')
+        self.assertEqual(host.getvalue(), 'HOST THREAD LINE\n')
+
+    def test_nested_run(self):
+        inner = lolcode.Interpreter()
+        results = []
+
+        class Output(io.StringIO):
+            def write(self, text):
+                if not results:     # Run another program mid-VISIBLE
+                    results.append(inner.run('HAI\nI HAS A x ITZ 2\n'
+                                             'VISIBLE x MKAY?\nKTHXBAI\n'))
+                return super().write(text)
+
+        outer = ('HAI\nI HAS A x ITZ 40\nVISIBLE x MKAY?\n'
+                 'VISIBLE SUM OF x AN 2 MKAY?\nKTHXBAI\n')
+        output = Output()
+        status = lolcode.Interpreter().run(outer, None, output).status
+        self.assertEqual(results, [lolcode.Result(0, '2 \n')])
+        self.assertEqual((status, output.getvalue()), (0, '40 \n42 \n'))
+
+    def test_timeout_while_restoring(self):
+        restore = lolcode.restoreState
+
+        def slowRestore(state):
+            time.sleep(0.5)     # The job runs out of time in here
+            restore(state)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'job.lol')
+            with open(path, 'w') as file:
+                file.write('HAI\nI HAS A x ITZ 1\nHOW DUZ I f\n'
+                           'IF U SAY SO\nKTHXBAI\n')
+            lolcode.restoreState = slowRestore
+            try:
+                status = lolcode.runJob(path, {}, 0.2)[0]
+            finally:
+                lolcode.restoreState = restore
+        self.assertIsNone(status)
+        self.assertEqual(lolcode.func, {})
+        self.assertEqual(lolcode.globalLayout, {'IT':0})
+
+if __name__ == "__main__":
+    unittest.main()